@@ -0,0 +1,194 @@
+# Copyright (c) 2021 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Packet encoder/decoder for the FPGADebugInterface protocol
+#
+# Command packet (11 bytes):  cmd, index, 8 bytes of data (big endian), checksum
+# Response packets:           code, checksum                       (2 bytes)
+#                             Rsp_read_data, 8 bytes of data, checksum (10 bytes)
+# The checksum is the sum of the preceding bytes plus 0x55, modulo 256, as
+# computed by mkFPGADebugInterface in bsv/FPGADebugInterface.bsv.
+#
+# Bursts move up to burst_max_words words to or from one index:
+# Write burst:   command packet {Cmd_write_burst, index, N}, N*8 bytes of
+#                data, checksum over the data;  answered with Rsp_write_burst_ack
+# Read burst:    command packet {Cmd_read_burst, index, N};  answered with
+#                Rsp_read_burst_data, N*8 bytes of data, checksum
+# decode_responses() does not handle Rsp_read_burst_data since its length
+# depends on the request.
+#
+# Command and response codes are passed as ints (e.g. DebugCommand.Cmd_read_word.value)
+# or as the DebugCommand enum.  NumPy is optional and only needed for the
+# *_array functions.
+
+import struct
+import sys
+from array import array
+from enum import Enum
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+command_packet = struct.Struct(">BBQB")
+command_header = struct.Struct(">BBQ")
+command_packet_size = command_packet.size
+read_data_response_size = 10
+short_response_size = 2
+
+RSP_READ_DATA = 3
+CMD_WRITE_BURST = 4
+CMD_READ_BURST = 5
+RSP_WRITE_BURST_ACK = 4
+RSP_READ_BURST_DATA = 5
+
+# DebugBurstMax in bsv/FPGADebugInterface.bsv
+burst_max_words = 256
+
+checksum_init = 0x55
+
+if(np != None):
+    command_dtype = np.dtype([("cmd", "u1"), ("index", "u1"), ("data", ">u8"), ("checksum", "u1")])
+    read_data_dtype = np.dtype([("code", "u1"), ("data", ">u8"), ("checksum", "u1")])
+
+def calc_checksum(packet) -> int:
+    return (sum(packet) + checksum_init) & 0xff
+
+def encode_command(cmd, index: int, data: int) -> bytes:
+    if(isinstance(cmd, Enum)):
+        cmd = cmd.value
+    header = command_header.pack(cmd, index, data)
+    return header + bytes(((sum(header) + checksum_init) & 0xff,))
+
+# Encode a sequence of (cmd, index, data) tuples into one buffer of
+# back-to-back command packets
+def encode_commands(commands) -> bytearray:
+    commands = list(commands)
+    buf = bytearray(command_packet_size * len(commands))
+    view = memoryview(buf)
+    pack_into = command_header.pack_into
+    off = 0
+    for (cmd, index, data) in commands:
+        if(isinstance(cmd, Enum)):
+            cmd = cmd.value
+        pack_into(buf, off, cmd, index, data)
+        end = off+command_packet_size-1
+        buf[end] = (sum(view[off:end]) + checksum_init) & 0xff
+        off = end+1
+    return buf
+
+# Encode a NumPy structured array with fields cmd, index and data (any
+# integer dtypes) into one buffer of command packets, computing all the
+# checksums in one vectorised operation
+def encode_commands_array(commands) -> bytes:
+    n = len(commands)
+    packets = np.empty(n, dtype=command_dtype)
+    packets["cmd"] = commands["cmd"]
+    packets["index"] = commands["index"]
+    packets["data"] = commands["data"]
+    raw = packets.view(np.uint8).reshape(n, command_packet_size)
+    raw[:, -1] = (raw[:, :-1].sum(axis=1, dtype=np.uint32) + checksum_init) & 0xff
+    return packets.tobytes()
+
+# Big endian bytes of a sequence of 64-bit words (e.g. an array('Q'), a
+# NumPy array or a list)
+def encode_words(values) -> bytes:
+    if((np != None) and isinstance(values, np.ndarray)):
+        return values.astype(">u8").tobytes()
+    words = array('Q', values)
+    if(sys.byteorder == 'little'):
+        words.byteswap()
+    return words.tobytes()
+
+def decode_words(buf):
+    words = array('Q', bytes(buf))
+    if(sys.byteorder == 'little'):
+        words.byteswap()
+    return words
+
+# Encode a write burst of 1..burst_max_words values to one index
+def encode_write_burst(index: int, values) -> bytes:
+    payload = encode_words(values)
+    n = len(payload)//8
+    if((n < 1) or (n > burst_max_words)):
+        raise ValueError("write burst of %d words, must be 1..%d" % (n, burst_max_words))
+    return encode_command(CMD_WRITE_BURST, index, n) + payload + bytes(((sum(payload) + checksum_init) & 0xff,))
+
+def encode_read_burst(index: int, count: int) -> bytes:
+    if((count < 1) or (count > burst_max_words)):
+        raise ValueError("read burst of %d words, must be 1..%d" % (count, burst_max_words))
+    return encode_command(CMD_READ_BURST, index, count)
+
+# Length of the response starting with the given code byte
+def response_size(code: int) -> int:
+    return read_data_response_size if(code == RSP_READ_DATA) else short_response_size
+
+# Decode as many complete responses as buf holds in one pass.  Returns
+# (codes, data, checksum_ok, consumed) where codes are ints, data is the
+# read data (None for responses without data), checksum_ok flags each
+# response's checksum and consumed is the number of bytes decoded; any
+# partial response at the end of buf is left for the caller.
+def decode_responses(buf):
+    view = memoryview(buf)
+    n = len(view)
+    codes = []
+    data = []
+    checksum_ok = []
+    off = 0
+    while(off < n):
+        code = view[off]
+        if(code == RSP_READ_DATA):
+            end = off+read_data_response_size
+            if(end > n):
+                break
+            data.append(int.from_bytes(view[off+1:end-1], "big"))
+        else:
+            end = off+short_response_size
+            if(end > n):
+                break
+            data.append(None)
+        codes.append(code)
+        checksum_ok.append(((sum(view[off:end-1]) + checksum_init) & 0xff) == view[end-1])
+        off = end
+    return (codes, data, checksum_ok, off)
+
+# Decode a buffer holding only Rsp_read_data responses into NumPy arrays
+# of codes, uint64 data and checksum flags in one vectorised pass
+def decode_read_responses_array(buf):
+    n = len(buf) // read_data_response_size
+    resp = np.frombuffer(buf, dtype=read_data_dtype, count=n)
+    raw = resp.view(np.uint8).reshape(n, read_data_response_size)
+    checksum_ok = ((raw[:, :-1].sum(axis=1, dtype=np.uint32) + checksum_init) & 0xff) == raw[:, -1]
+    return (resp["code"].copy(), resp["data"].astype(np.uint64), checksum_ok)
+
+# Decode a buffer holding only short responses into NumPy arrays of codes
+# and checksum flags
+def decode_short_responses_array(buf):
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(-1, short_response_size)
+    checksum_ok = ((raw[:, 0].astype(np.uint32) + checksum_init) & 0xff) == raw[:, 1]
+    return (raw[:, 0].copy(), checksum_ok)
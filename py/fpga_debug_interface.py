@@ -28,10 +28,60 @@
 # ----------------------------------------------------------------------------
 # Library to use the hardware FPGADebugInterface
 
-import fpga_debug_pipe_sim
-import fpga_debug_pipe_fpga
+import fpga_debug_transport
+import fpga_debug_codec
+import fpga_debug_metrics
+import fpga_debug_vectors
+import fpga_debug_trace
+import os
 import time
+import asyncio
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from enum import Enum
+from collections import deque
+
+# Maximum number of commands a batch keeps in flight before waiting for
+# responses.  Sized so that the requests (11B each) fit in the receive side
+# of FPGADebugInterface (64B JTAG UART FIFO + shift register + request FIFO)
+# and the responses (up to 10B each) fit in the transmit side (64B JTAG UART
+# FIFO + response FIFOs), so the link never deadlocks even if the host is
+# slow to collect responses.
+batch_max_in_flight = 8
+
+# Maximum number of bursts read_block() and write_block() keep in flight,
+# enough to keep the link busy while the response to the previous burst is
+# collected.  FPGADebugInterface stops receiving while it passes a burst to
+# the device under test so more would only fill the JTAG UART.
+burst_max_in_flight = 2
+
+# Time to wait for the answer to the burst probe (see burst_probe) before
+# taking the FPGADebugInterface build to be one without bursts
+burst_probe_timeout = 0.5
+
+# Number of commands per batch used by read_block() and write_block(), which
+# bounds the memory used for the command and result lists of large blocks
+block_batch_size = 4096
+
+# Defaults for wait_until(): time in seconds before giving up, and the first
+# and longest intervals between polls
+wait_timeout = 60.0
+wait_min_interval = 0.0001
+wait_max_interval = 0.1
+
+# Link resync (see clear()): enough zero bytes to end a partly received
+# packet or write burst, then packets with a bad checksum that are each
+# answered with Rsp_checksum_fail without reaching the device under test.
+resync_markers = 4
+resync_timeout = 5.0
+# Time to wait after the marker responses for any more, as a multiple of
+# the time the resync has taken so far, within these limits
+resync_settle = 2.0
+resync_min_settle = 0.001
+resync_max_settle = 0.05
 
 # classes to match the command and response codes in FPGADebugInterface
 class DebugCommand(Enum):
@@ -39,6 +89,8 @@ class DebugCommand(Enum):
     Cmd_reset         =   1
     Cmd_write_word    =   2
     Cmd_read_word     =   3
+    Cmd_write_burst   =   4
+    Cmd_read_burst    =   5
     Cmd_end_sim       = 254
     Cmd_invalid       = 255
 
@@ -47,59 +99,849 @@ class DebugResponseCode(Enum):
     Rsp_reset_done    =   1
     Rsp_write_ack     =   2
     Rsp_read_data     =   3
+    Rsp_write_burst_ack = 4
+    Rsp_read_burst_data = 5
     Rsp_checksum_fail = 254
     Rsp_invalid       = 255
 
+response_codes = {c.value: c for c in DebugResponseCode}
+
+resync_flush = bytes(fpga_debug_codec.command_packet_size + 8*fpga_debug_codec.burst_max_words + 1)
+resync_marker = bytes((DebugCommand.Cmd_invalid.value,)) + bytes(fpga_debug_codec.command_packet_size-1)
+resync_response = bytes((DebugResponseCode.Rsp_checksum_fail.value,
+                         fpga_debug_codec.calc_checksum((DebugResponseCode.Rsp_checksum_fail.value,))))
+
+# Drains the link after a resync has been sent until the responses to the
+# markers have arrived.  Stale responses may also end in Rsp_checksum_fail,
+# in which case the match comes early with some marker responses still to
+# arrive right behind, so the link must then stay quiet for a short settle
+# time (proportional to the time taken so far) before it counts as clean.
+class link_resync:
+    def __init__(self, timeout=resync_timeout):
+        self.start = time.monotonic()
+        self.deadline = self.start+timeout
+        self.expected = resync_response*resync_markers
+        self.tail = b''
+        self.settle_end = None
+        self.finished = False
+
+    def done(self) -> bool:
+        return self.finished
+
+    # How long to wait for more bytes
+    def wait_time(self) -> float:
+        return max(0.0, (self.deadline if(self.settle_end==None) else self.settle_end) - time.monotonic())
+
+    def put_bytes(self, data):
+        now = time.monotonic()
+        if(len(data) > 0):
+            self.tail = (self.tail + data)[-len(self.expected):]
+            if(self.tail == self.expected):
+                self.settle_end = now + min(max(resync_settle*(now-self.start), resync_min_settle), resync_max_settle)
+            else:
+                self.settle_end = None
+        elif((self.settle_end != None) and (now >= self.settle_end)):
+            self.finished = True
+        if((self.settle_end == None) and (now >= self.deadline)):
+            print("ERROR: no response to the link resync after %.1fs" % (self.deadline-self.start))
+            raise DebugInterfaceTimeoutError("no response to the link resync after %.1fs" % (self.deadline-self.start))
+
+    def elapsed(self) -> float:
+        return time.monotonic()-self.start
+
+# Bookkeeping for a pipelined batch of commands, independent of how the
+# bytes are moved.  Up to max_in_flight commands are outstanding at any time
+# and commands are sent in as few put_bytes calls as possible.  Only
+# Cmd_write_word and Cmd_read_word may be batched since they are the only
+# commands that are guaranteed to produce exactly one response.
+#
+# FPGADebugInterface sends read data in preference to response codes, so a
+# write ack can overtake the data for an earlier read.  Responses are
+# therefore matched to commands per stream: read data in order of the reads,
+# everything else in order of the writes.  A checksum failure on a read
+# packet arrives in the response code stream and is attributed to the oldest
+# outstanding read once no writes are outstanding.
+#
+# The commands are a sequence of (DebugCommand, index, data) tuples or,
+# with commands=None, a buffer of already encoded command packets.
+#
+# With arrays=True (needs NumPy) the received bytes are only framed, to
+# count the responses, and decode_arrays() decodes them all in one pass into
+# the codes and data arrays instead of a list of (DebugResponseCode, data)
+# results.  The read data is then matched to the reads in order and the
+# other responses to the writes in order and then to any reads left over.
+class command_batch:
+    def __init__(self, commands, max_in_flight=batch_max_in_flight, metrics=None, packets=None, arrays=False):
+        if(packets == None):
+            packets = fpga_debug_codec.encode_commands(commands)
+        self.packets = memoryview(packets).cast('B')
+        self.cmds = bytes(self.packets[0::fpga_debug_codec.command_packet_size])
+        self.n = len(self.cmds)
+        for c in set(self.cmds):
+            if(c not in (DebugCommand.Cmd_write_word.value, DebugCommand.Cmd_read_word.value)):
+                raise ValueError("batch() only supports Cmd_write_word and Cmd_read_word, not %s" % (DebugCommand(c)))
+            if(metrics != None):
+                metrics.count_command(DebugCommand(c), self.cmds.count(c))
+        self.metrics = metrics
+        self.send_times = [0.0] * self.n if(metrics != None) else None
+        self.max_in_flight = max_in_flight
+        self.arrays = arrays
+        if(arrays):
+            is_read = np.frombuffer(self.cmds, dtype=np.uint8) == DebugCommand.Cmd_read_word.value
+            self.read_order = np.nonzero(is_read)[0]
+            self.write_order = np.nonzero(~is_read)[0]
+            self.reads_sent = 0
+            self.reads_done = 0
+            self.writes_done = 0
+            self.raw = bytearray()
+            self.framed = 0
+            self.frame_is_data = bytearray()  # 1 for each Rsp_read_data response, 0 for each short one
+            self.codes = None
+            self.data = None
+        else:
+            self.results = [None] * self.n
+            self.pending_reads = deque()
+            self.pending_writes = deque()
+        self.partial = b''
+        self.sent = 0
+        self.received = 0
+
+    def done(self) -> bool:
+        return self.received >= self.n
+
+    # Bytes for the commands that can be sent now, empty if the window is full
+    def next_tx(self):
+        if((self.sent < self.n) and (self.sent-self.received < self.max_in_flight)):
+            start = self.sent
+            end = min(self.n, self.received+self.max_in_flight)
+            if(self.arrays):
+                self.reads_sent = int(np.searchsorted(self.read_order, end))
+            else:
+                for j in range(start, end):
+                    if(self.cmds[j] == DebugCommand.Cmd_read_word.value):
+                        self.pending_reads.append(j)
+                    else:
+                        self.pending_writes.append(j)
+            self.sent = end
+            if(self.metrics != None):
+                now = time.perf_counter()
+                for j in range(start, end):
+                    self.send_times[j] = now
+            size = fpga_debug_codec.command_packet_size
+            return self.packets[start*size:end*size]
+        return b''
+
+    # Fewest bytes that will complete at least one more response
+    def min_rx_bytes(self) -> int:
+        if(len(self.partial) > 0):
+            return fpga_debug_codec.response_size(self.partial[0]) - len(self.partial)
+        return fpga_debug_codec.short_response_size
+
+    # Most bytes the outstanding commands can still produce
+    def max_rx_bytes(self) -> int:
+        if(self.arrays):
+            reads = self.reads_sent-self.reads_done
+            writes = (self.sent-self.reads_sent)-self.writes_done
+        else:
+            reads = len(self.pending_reads)
+            writes = len(self.pending_writes)
+        outstanding = (fpga_debug_codec.read_data_response_size*reads
+                       + fpga_debug_codec.short_response_size*writes)
+        return max(self.min_rx_bytes(), outstanding - len(self.partial))
+
+    # Decode a chunk of received bytes in bulk, keeping any partial response
+    # at the end for the next chunk
+    def put_response_bytes(self, buf):
+        if(self.arrays):
+            self.put_raw_bytes(buf)
+            return
+        if(len(self.partial) > 0):
+            buf = self.partial + bytes(buf)
+        (codes, data, checksum_ok, consumed) = fpga_debug_codec.decode_responses(buf)
+        self.partial = bytes(buf[consumed:])
+        for j in range(len(codes)):
+            if(not(checksum_ok[j])):
+                print("ERROR: checksum failed on batch response")
+                if(self.metrics != None):
+                    self.metrics.checksum_failures = self.metrics.checksum_failures+1
+                raise DebugInterfaceChecksumError
+            code = response_codes.get(codes[j])
+            if(code == None):
+                code = DebugResponseCode(codes[j])
+            self.put_response(code, data[j])
+
+    def put_response(self, code, data):
+        if((code == DebugResponseCode.Rsp_read_data) and self.pending_reads):
+            j = self.pending_reads.popleft()
+        elif(self.pending_writes):
+            j = self.pending_writes.popleft()
+        elif(self.pending_reads):
+            j = self.pending_reads.popleft()
+        else:
+            print("ERROR: batch received unexpected response: ",code)
+            return
+        self.results[j] = (code, data)
+        self.received = self.received+1
+        if(self.metrics != None):
+            self.metrics.latency.add(time.perf_counter()-self.send_times[j])
+            self.metrics.count_response(code)
+
+    # Keep the received bytes for decode_arrays(), stepping over the
+    # complete responses to count them per stream and note their layout
+    def put_raw_bytes(self, buf):
+        raw = self.raw
+        raw += buf
+        layout = self.frame_is_data
+        off = self.framed
+        reads = 0
+        others = 0
+        while(off < len(raw)):
+            if(raw[off] == fpga_debug_codec.RSP_READ_DATA):
+                end = off+fpga_debug_codec.read_data_response_size
+                if(end > len(raw)):
+                    break
+                reads = reads+1
+                layout.append(1)
+            else:
+                end = off+fpga_debug_codec.short_response_size
+                if(end > len(raw)):
+                    break
+                others = others+1
+                layout.append(0)
+            off = end
+        self.framed = off
+        self.partial = bytes(raw[off:])
+        writes = min(others, (self.sent-self.reads_sent)-self.writes_done)
+        reads = min(reads+others-writes, self.reads_sent-self.reads_done)
+        if(self.metrics != None):
+            now = time.perf_counter()
+            for j in np.concatenate((self.read_order[self.reads_done:self.reads_done+reads],
+                                     self.write_order[self.writes_done:self.writes_done+writes])):
+                self.metrics.latency.add(now-self.send_times[j])
+        self.reads_done = self.reads_done+reads
+        self.writes_done = self.writes_done+writes
+        self.received = self.received+reads+writes
+
+    # Decode all the responses of a finished batch into the codes and data
+    # arrays.  The layout noted by put_raw_bytes() gives the offset of every
+    # response with one cumsum, so the read data and the short responses
+    # are each gathered and decoded in one pass.
+    def decode_arrays(self):
+        is_data = np.frombuffer(self.frame_is_data, dtype=np.uint8).astype(bool)
+        sizes = np.where(is_data, fpga_debug_codec.read_data_response_size, fpga_debug_codec.short_response_size)
+        starts = np.cumsum(sizes) - sizes
+        raw = np.frombuffer(bytes(self.raw), dtype=np.uint8)
+        frames = raw[starts[is_data][:, None] + np.arange(fpga_debug_codec.read_data_response_size)]
+        (data_codes, data, data_ok) = fpga_debug_codec.decode_read_responses_array(frames.tobytes())
+        frames = raw[starts[~is_data][:, None] + np.arange(fpga_debug_codec.short_response_size)]
+        (other_codes, other_ok) = fpga_debug_codec.decode_short_responses_array(frames.tobytes())
+        if(not(data_ok.all() and other_ok.all())):
+            print("ERROR: checksum failed on batch response")
+            if(self.metrics != None):
+                self.metrics.checksum_failures = self.metrics.checksum_failures+1
+            raise DebugInterfaceChecksumError
+        nd = min(len(data_codes), len(self.read_order))
+        nw = min(len(other_codes), len(self.write_order))
+        nr = min(len(other_codes)-nw, len(self.read_order)-nd)
+        if((nd < len(data_codes)) or (nw+nr < len(other_codes))):
+            print("ERROR: batch received %d unexpected responses" % (len(data_codes)+len(other_codes)-nd-nw-nr))
+        index = np.concatenate((self.read_order[:nd], self.write_order[:nw], self.read_order[nd:nd+nr]))
+        self.codes = np.zeros(self.n, dtype=np.uint8)
+        self.data = np.zeros(self.n, dtype=np.uint64)
+        self.codes[index] = np.concatenate((data_codes[:nd], other_codes[:nw+nr]))
+        self.data[index[:nd]] = data[:nd]
+        if(self.metrics != None):
+            (values, counts) = np.unique(self.codes[index], return_counts=True)
+            for (code, count) in zip(values, counts):
+                name = DebugResponseCode(int(code)).name
+                self.metrics.responses[name] = self.metrics.responses.get(name, 0)+int(count)
+
+# Bookkeeping for a transfer of count words to or from one index as bursts
+# of up to burst words (see fpga_debug_codec), with up to max_in_flight
+# bursts outstanding.  Responses to bursts arrive in order.  A write burst
+# takes the words from values[start:start+n]; a read burst stores them in
+# out[start:start+n].
+class burst_transfer:
+    def __init__(self, cmd, index, count, burst=fpga_debug_codec.burst_max_words, max_in_flight=burst_max_in_flight,
+                 values=None, out=None, metrics=None):
+        self.cmd = cmd
+        self.index = index
+        self.chunks = [(start, min(burst, count-start)) for start in range(0, count, burst)]
+        self.values = values
+        self.out = out
+        self.metrics = metrics
+        self.max_in_flight = max_in_flight
+        self.codes = []
+        self.failed = []  # positions of the words in write bursts that were not acked
+        self.send_times = deque()
+        self.sent = 0
+        self.received = 0
+
+    def done(self) -> bool:
+        return self.received >= len(self.chunks)
+
+    # Bytes for the bursts that can be sent now, empty if the window is full
+    def next_tx(self):
+        tx = []
+        while((self.sent < len(self.chunks)) and (self.sent-self.received < self.max_in_flight)):
+            (start, n) = self.chunks[self.sent]
+            if(self.cmd == DebugCommand.Cmd_write_burst):
+                tx.append(fpga_debug_codec.encode_write_burst(self.index, self.values[start:start+n]))
+            else:
+                tx.append(fpga_debug_codec.encode_read_burst(self.index, n))
+            self.sent = self.sent+1
+            if(self.metrics != None):
+                self.metrics.count_command(self.cmd)
+                self.send_times.append(time.perf_counter())
+        return b''.join(tx)
+
+    # Number of bytes following the response code first
+    def response_size(self, first) -> int:
+        if(first == fpga_debug_codec.RSP_READ_BURST_DATA):
+            return self.chunks[self.received][1]*8+1
+        return fpga_debug_codec.short_response_size-1
+
+    def put_response(self, first, rest):
+        (start, n) = self.chunks[self.received]
+        self.received = self.received+1
+        if(((first + sum(rest[0:-1]) + fpga_debug_codec.checksum_init) & 0xff) != rest[-1]):
+            print("ERROR: checksum failed on burst response")
+            if(self.metrics != None):
+                self.metrics.checksum_failures = self.metrics.checksum_failures+1
+            raise DebugInterfaceChecksumError
+        code = response_codes.get(first)
+        if(code == None):
+            code = DebugResponseCode(first)
+        self.codes.append(code)
+        if(self.metrics != None):
+            self.metrics.latency.add(time.perf_counter()-self.send_times.popleft())
+            self.metrics.count_response(code)
+        if(self.cmd == DebugCommand.Cmd_read_burst):
+            if(code != DebugResponseCode.Rsp_read_burst_data):
+                print("ERROR read burst of %d words from index %d failed - received response: " % (n, self.index), code)
+                raise DebugInterfaceBlockError
+            self.out[start:start+n] = fpga_debug_codec.decode_words(rest[0:-1])
+        elif(code != DebugResponseCode.Rsp_write_burst_ack):
+            print("ERROR write burst of %d words to index %d failed - received response: " % (n, self.index), code)
+            self.failed.extend(range(start, start+n))
+
+    # Record the words as the equivalent Cmd_write_word or Cmd_read_word
+    # test vectors
+    def record(self, recorder):
+        for (j, code) in enumerate(self.codes):
+            (start, n) = self.chunks[j]
+            for k in range(start, start+n):
+                if(self.cmd == DebugCommand.Cmd_read_burst):
+                    packet = fpga_debug_codec.encode_command(DebugCommand.Cmd_read_word, self.index, 0)
+                    recorder.add(packet, DebugResponseCode.Rsp_read_data, int(self.out[k]))
+                else:
+                    packet = fpga_debug_codec.encode_command(DebugCommand.Cmd_write_word, self.index, int(self.values[k]))
+                    recorder.add(packet, DebugResponseCode.Rsp_write_ack if(code == DebugResponseCode.Rsp_write_burst_ack) else code, None)
+
+# Run op, a link operation of debug_interface, as one transaction (see
+# debug_interface.run)
+def locked(op):
+    return (yield ('locked', op))
+
+# Link operation that finds whether the FPGADebugInterface build handles
+# bursts.  A read burst of zero words is answered with Rsp_invalid without
+# reaching the device under test, while a build from before bursts passes it
+# to the device under test, which ignores it, and sends nothing back.
+burst_probe_packet = fpga_debug_codec.encode_command(fpga_debug_codec.CMD_READ_BURST, 0, 0)
+burst_probe_response = bytes((DebugResponseCode.Rsp_invalid.value,
+                              fpga_debug_codec.calc_checksum((DebugResponseCode.Rsp_invalid.value,))))
+
+def burst_probe(timeout=burst_probe_timeout):
+    yield ('put_bytes', burst_probe_packet)
+    deadline = time.monotonic()+timeout
+    rx = b''
+    while((len(rx) < len(burst_probe_response)) and (time.monotonic() < deadline)):
+        rx = rx + (yield ('read_available', max(0.0, deadline-time.monotonic())))
+    return rx == burst_probe_response
+
 class debug_interface:
-    def __init__(self, sim=True, cable_name = None, device_nr = -1, instance_nr = -1):
+    traced_pipe_class = fpga_debug_trace.traced_pipe
+
+    # reader_thread=True drains the JTAG UART from a background thread (FPGA only)
+    # broker=True connects via the link_broker.py daemon serving the
+    # simulation or cable_name, or broker can be the broker's socket path
+    # metrics=True collects link statistics in self.metrics (see fpga_debug_metrics)
+    # loopback=True runs against the in-process model of FPGADebugInterface
+    # with the tstFPGADebugInterface register file, or loopback can be the
+    # DUT callable for the model (see fpga_debug_pipe_loopback)
+    # trace=True (or a number of slots) keeps a trace of the link traffic
+    # that is written to a file on link errors (see fpga_debug_trace)
+    # transport is a URI such as "sim:///path/to/pipes" or
+    # "jtag://DE10-Pro [5-2.3.1]" selecting the link instead of the arguments
+    # above (see fpga_debug_transport)
+    # pipe_dir is the directory holding the simulation pipes (default: the
+    # current directory or $FPGA_DEBUG_PIPE_DIR)
+    def __init__(self, sim=True, cable_name = None, device_nr = -1, instance_nr = -1, reader_thread = False, broker = False,
+                 metrics = False, loopback = False, trace = False, transport = None, pipe_dir = None):
         self.sim_mode = sim
-        if(sim):
-            self.pipe = fpga_debug_pipe_sim.pipe_interface()
+        if(transport != None):
+            self.pipe = fpga_debug_transport.open_transport(transport)
+            simulation = fpga_debug_transport.is_simulation(transport)
+            self.sim_mode = sim if(simulation == None) else simulation
+        elif(loopback):
+            loopback_pipe = fpga_debug_transport.transport_module('loopback')
+            self.pipe = loopback_pipe.pipe_interface(dut = None if(loopback is True) else loopback)
+        elif(broker):
+            broker_pipe = fpga_debug_transport.transport_module('broker')
+            path = broker if(isinstance(broker, str)) else broker_pipe.socket_path(None if(sim) else cable_name)
+            self.pipe = broker_pipe.pipe_interface(path = path)
+        elif(sim):
+            self.pipe = fpga_debug_transport.transport_module('sim').pipe_interface(path = pipe_dir)
         else:
-            self.pipe = fpga_debug_pipe_fpga.pipe_interface(cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr)
+            self.pipe = fpga_debug_transport.transport_module('jtag').pipe_interface(
+                cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr, reader_thread = reader_thread)
+        self.commands_sent = 0  # for throughput reporting
+        self.recorder = None
+        self.burst_support = None  # unknown until bursts_supported()
+        self.enable_metrics(metrics)
+        self.enable_trace(trace)
+
+    def enable_metrics(self, enable=True):
+        self.metrics = fpga_debug_metrics.link_metrics() if(enable) else None
+        self.pipe.metrics = self.metrics
+        self.command_time = 0.0
+
+    def enable_trace(self, slots=True):
+        if(isinstance(self.pipe, fpga_debug_trace.traced_pipe)):
+            self.pipe = self.pipe.pipe
+        self.trace = None
+        self.trace_path = "fpga-debug-trace-%d.bin" % (os.getpid())
+        if(slots):
+            self.trace = fpga_debug_trace.packet_trace(fpga_debug_trace.default_slots if(slots is True) else slots)
+            self.pipe = self.traced_pipe_class(self.pipe, self.trace, self.trace_error)
+
+    def dump_trace(self, path=None):
+        path = self.trace_path if(path==None) else path
+        self.trace.dump(path)
+        return path
+
+    # Called on link errors to save the trace
+    def trace_error(self):
+        if(self.trace != None):
+            print("Packet trace written to %s" % (self.dump_trace()))
+
+    # Record writes and reads with their responses as test vectors (see
+    # fpga_debug_vectors)
+    def start_recording(self, path):
+        self.stop_recording()
+        self.recorder = fpga_debug_vectors.vector_recorder(path)
+
+    def stop_recording(self):
+        if(self.recorder != None):
+            self.recorder.close()
+            self.recorder = None
+
+    # Record the latency and response code of a single command
+    def record_response(self, code):
+        self.metrics.latency.add(time.perf_counter()-self.command_time)
+        self.metrics.count_response(code)
+
+    def count_checksum_failure(self):
+        if(self.metrics != None):
+            self.metrics.checksum_failures = self.metrics.checksum_failures+1
+        self.trace_error()
 
     def assert_checksum(self, packet_list, error_message):
         checksum = self.pipe.calc_checksum(packet_list[0:-1])
         if(checksum != packet_list[-1]):
             print(error_message)
+            self.count_checksum_failure()
             raise DebugInterfaceChecksumError
             
-    def put_command(self, cmd: DebugCommand, index: int, data: int):
-        packet = [cmd.value, index]+list(data.to_bytes(8,"big"))
-        checksum = self.pipe.calc_checksum(packet)
-        # print("DEBUG: put_command sending: [",", ".join(list(map(lambda a: "0x%02x"%(a), packet+[checksum]))),"]")
-        self.pipe.put_bytes(packet+[checksum])
+    def encode_command(self, cmd: DebugCommand, index: int, data: int) -> bytes:
+        return fpga_debug_codec.encode_command(cmd.value, index, data)
 
-    def get_response_code(self):
-        resp = self.pipe.get_bytes(2)
+    # Check the checksum of a response whose first byte (the response code)
+    # has already been consumed from the pipe
+    def assert_response_checksum(self, first, rest, error_message):
+        if(((first + self.pipe.calc_checksum(rest[0:-1])) & 0xff) != rest[-1]):
+            print(error_message)
+            self.count_checksum_failure()
+            raise DebugInterfaceChecksumError
+
+    # Run a link operation.  Operations are generators that yield the pipe
+    # calls they need as (method name, arguments...), e.g. ('get_bytes', 10),
+    # and are sent the results, so the protocol is written once for this
+    # class and async_debug_interface, which only differ in how run() and
+    # perform() make the calls.  ('sleep', seconds) pauses and ('locked', op)
+    # runs op as one transaction on the link.
+    def run(self, op):
+        result = None
+        while(True):
+            try:
+                request = op.send(result)
+            except StopIteration as e:
+                return e.value
+            result = self.perform(request)
+
+    def perform(self, request):
+        if(request[0] == 'locked'):
+            return self.run(request[1])
+        if(request[0] == 'sleep'):
+            time.sleep(request[1])
+            return None
+        return getattr(self.pipe, request[0])(*request[1:])
+
+    def put_command_op(self, cmd: DebugCommand, index: int, data: int):
+        packet = self.encode_command(cmd, index, data)
+        # print("DEBUG: put_command sending: [",", ".join(list(map(lambda a: "0x%02x"%(a), packet))),"]")
+        yield ('put_bytes', packet)
+        self.commands_sent = self.commands_sent+1
+        if(self.metrics != None):
+            self.metrics.count_command(cmd)
+            self.command_time = time.perf_counter()
+
+    # Receive one response of either length: Rsp_read_data carries 8 bytes of
+    # data, every other response code is just the code plus checksum.  The
+    # bytes from the pipe are decoded in place without copying.
+    def get_response_op(self):
+        first = (yield ('get_bytes', 1))[0]
+        code = DebugResponseCode(first)
+        resp = yield ('get_bytes', 9 if(code == DebugResponseCode.Rsp_read_data) else 1)
+        self.assert_response_checksum(first, resp, "ERROR: checksum failed on get_response")
+        return (code, int.from_bytes(resp[0:8],"big") if(len(resp) == 9) else None)
+
+    def get_response_code_op(self):
+        resp = yield ('get_bytes', 2)
         code = DebugResponseCode(resp[0])
         self.assert_checksum(resp, "ERROR: checksum failed on get_response_code")
         return code
 
-    def write(self, index: int, data: int):
-        self.put_command(DebugCommand.Cmd_write_word, index, data)
-        code = self.get_response_code()
+    def put_command(self, cmd: DebugCommand, index: int, data: int):
+        return self.run(locked(self.put_command_op(cmd, index, data)))
+
+    def get_response_code(self):
+        return self.run(locked(self.get_response_code_op()))
+
+    def write_op(self, index: int, data: int):
+        yield from self.put_command_op(DebugCommand.Cmd_write_word, index, data)
+        code = yield from self.get_response_code_op()
+        if(self.metrics != None):
+            self.record_response(code)
+        if(self.recorder != None):
+            self.recorder.add(self.encode_command(DebugCommand.Cmd_write_word, index, data), code, None)
         if(code != DebugResponseCode.Rsp_write_ack):
             print("ERROR write failed - received response: ",code)
-            
-    def read(self, index: int) -> int:
-        self.put_command(DebugCommand.Cmd_read_word, index, 0)
-        resp = self.pipe.get_bytes(10)
-        code = DebugResponseCode(resp[0])
+
+    # A failed read is answered with a short response code, so the response
+    # length is taken from its first byte
+    def read_op(self, index: int):
+        yield from self.put_command_op(DebugCommand.Cmd_read_word, index, 0)
+        (code, data) = yield from self.get_response_op()
+        if(self.metrics != None):
+            self.record_response(code)
+        if(self.recorder != None):
+            self.recorder.add(self.encode_command(DebugCommand.Cmd_read_word, index, 0), code, data)
         if(code != DebugResponseCode.Rsp_read_data):
             print("ERROR read failed - received response: ",code)
             return None
-        else:
-            self.assert_checksum(resp,"ERROR checksum error for read()")
-            return int.from_bytes(bytes(resp[1:9]),"big")
+        return data
 
-    def clear(self):
-        self.pipe.put_bytes([0]*12)
-        self.pipe.clear_read_buf()
+    def write(self, index: int, data: int):
+        return self.run(locked(self.write_op(index, data)))
 
-    def end_simulation(self):
+    def read(self, index: int) -> int:
+        return self.run(locked(self.read_op(index)))
+
+    def batch_op(self, commands, max_in_flight=batch_max_in_flight, packets=None, arrays=False):
+        b = command_batch(commands, max_in_flight, self.metrics, packets, arrays)
+        self.commands_sent = self.commands_sent+b.n
+        while(not(b.done())):
+            tx = b.next_tx()
+            if(tx):
+                yield ('put_bytes', tx)
+            rx = yield ('get_bytes_upto', b.min_rx_bytes(), b.max_rx_bytes())
+            try:
+                b.put_response_bytes(rx)
+            except DebugInterfaceChecksumError:
+                self.trace_error()
+                raise
+        if(b.arrays):
+            try:
+                b.decode_arrays()
+            except DebugInterfaceChecksumError:
+                self.trace_error()
+                raise
+            if(self.recorder != None):
+                self.recorder.add_arrays(b.packets, b.codes, b.data)
+            return (b.codes, b.data)
+        if(self.recorder != None):
+            self.recorder.add_batch(b.packets, b.results)
+        return b.results
+
+    # Send a list of (DebugCommand, index, data) tuples, or a buffer of
+    # encoded command packets, as a pipelined batch and return a list of
+    # (DebugResponseCode, data) in command order, or with arrays=True a
+    # tuple of NumPy arrays of the response codes and data.  See
+    # command_batch for details.
+    def batch(self, commands, max_in_flight=batch_max_in_flight, packets=None, arrays=False):
+        return self.run(locked(self.batch_op(commands, max_in_flight, packets, arrays)))
+
+    def bursts_op(self, b):
+        self.commands_sent = self.commands_sent+len(b.chunks)
+        while(not(b.done())):
+            tx = b.next_tx()
+            if(tx):
+                yield ('put_bytes', tx)
+            first = (yield ('get_bytes', 1))[0]
+            rest = yield ('get_bytes', b.response_size(first))
+            try:
+                b.put_response(first, rest)
+            except DebugInterfaceChecksumError:
+                self.trace_error()
+                raise
+        if(self.recorder != None):
+            b.record(self.recorder)
+        return b
+
+    # Run a burst_transfer
+    def bursts(self, b):
+        return self.run(locked(self.bursts_op(b)))
+
+    def write_many_commands(self, index_data_pairs) -> list:
+        return [(DebugCommand.Cmd_write_word, index, data) for (index, data) in index_data_pairs]
+
+    def write_many_failures(self, cmds, results) -> list:
+        failed = []
+        for (j, (code, data)) in enumerate(results):
+            if(code != DebugResponseCode.Rsp_write_ack):
+                print("ERROR write_many[%d] to index %d failed - received response: " % (j, cmds[j][1]), code)
+                failed.append(j)
+        return failed
+
+    def read_many_commands(self, indices) -> list:
+        return [(DebugCommand.Cmd_read_word, index, 0) for index in indices]
+
+    def read_many_values(self, cmds, results) -> list:
+        values = []
+        for (j, (code, data)) in enumerate(results):
+            if(code != DebugResponseCode.Rsp_read_data):
+                print("ERROR read_many[%d] from index %d failed - received response: " % (j, cmds[j][1]), code)
+                values.append(None)
+            else:
+                values.append(data)
+        return values
+
+    def write_many_op(self, index_data_pairs, max_in_flight=batch_max_in_flight):
+        cmds = self.write_many_commands(index_data_pairs)
+        return self.write_many_failures(cmds, (yield from locked(self.batch_op(cmds, max_in_flight))))
+
+    def read_many_op(self, indices, max_in_flight=batch_max_in_flight):
+        cmds = self.read_many_commands(indices)
+        return self.read_many_values(cmds, (yield from locked(self.batch_op(cmds, max_in_flight))))
+
+    # Pipelined write of a sequence of (index, data) pairs.  Returns a list
+    # of the positions in the sequence of any writes that were not acked.
+    def write_many(self, index_data_pairs, max_in_flight=batch_max_in_flight) -> list:
+        return self.run(self.write_many_op(index_data_pairs, max_in_flight))
+
+    # Pipelined read of a sequence of indices.  Returns the values read in
+    # order with None in place of any read that failed.
+    def read_many(self, indices, max_in_flight=batch_max_in_flight) -> list:
+        return self.run(self.read_many_op(indices, max_in_flight))
+
+    def read_block_buffer(self, count, out):
+        if(out is None):
+            return array('Q', bytes(8*count))
+        if(len(out) < count):
+            raise ValueError("read_block() buffer holds %d words but %d requested" % (len(out), count))
+        return out
+
+    # Copy the results of reading out[start:start+len(results)]
+    def read_block_values(self, index, start, results, out):
+        for (j, (code, data)) in enumerate(results):
+            if(code != DebugResponseCode.Rsp_read_data):
+                print("ERROR read_block[%d] from index %d failed - received response: " % (start+j, index), code)
+                raise DebugInterfaceBlockError
+            out[start+j] = data
+
+    def bursts_supported_op(self):
+        if(self.burst_support == None):
+            self.burst_support = yield from locked(burst_probe())
+            if(not(self.burst_support)):
+                print("WARNING: the FPGADebugInterface build does not handle bursts, using single word commands")
+                yield from locked(self.clear_op(resync_timeout))
+        return self.burst_support
+
+    # Whether the FPGADebugInterface build handles bursts, probed once on
+    # first use (see burst_probe).  read_block() and write_block() fall back
+    # to single word commands without them.
+    def bursts_supported(self) -> bool:
+        return self.run(self.bursts_supported_op())
+
+    def read_block_op(self, index, count, out, max_in_flight, burst):
+        count = len(out) if(count==None) else count
+        out = self.read_block_buffer(count, out)
+        if((burst > 0) and (yield from self.bursts_supported_op())):
+            yield from locked(self.bursts_op(burst_transfer(DebugCommand.Cmd_read_burst, index, count, burst,
+                                                            out=out, metrics=self.metrics)))
+            return out
+        for start in range(0, count, block_batch_size):
+            cmds = self.read_many_commands([index] * min(block_batch_size, count-start))
+            self.read_block_values(index, start, (yield from locked(self.batch_op(cmds, max_in_flight))), out)
+        return out
+
+    def write_block_op(self, index, values, max_in_flight, burst):
+        if((burst > 0) and (yield from self.bursts_supported_op())):
+            b = yield from locked(self.bursts_op(burst_transfer(DebugCommand.Cmd_write_burst, index, len(values), burst,
+                                                                values=values, metrics=self.metrics)))
+            return b.failed
+        failed = []
+        for start in range(0, len(values), block_batch_size):
+            cmds = self.write_many_commands([(index, int(d)) for d in values[start:start+block_batch_size]])
+            results = yield from locked(self.batch_op(cmds, max_in_flight))
+            failed.extend([start+j for j in self.write_many_failures(cmds, results)])
+        return failed
+
+    # Read count words from one index, e.g. to drain a DUT FIFO, as read
+    # bursts of up to burst words, or with burst=0 as pipelined batches of
+    # Cmd_read_word, which is also used if the FPGADebugInterface build
+    # turns out not to handle bursts (see bursts_supported()).  The
+    # words are stored in place in out, which may be an array('Q'), a NumPy
+    # uint64 array or a list; if out is None a new array('Q') is returned.
+    # Raises DebugInterfaceBlockError if any read is not answered with data.
+    def read_block(self, index, count=None, out=None, max_in_flight=batch_max_in_flight,
+                   burst=fpga_debug_codec.burst_max_words):
+        return self.run(self.read_block_op(index, count, out, max_in_flight, burst))
+
+    # Write a sequence of words (e.g. an array('Q') or NumPy uint64 array) to
+    # one index as write bursts of up to burst words, or with burst=0 as
+    # pipelined batches of Cmd_write_word, as for read_block().  Returns a
+    # list of the positions of any writes that were not acked.
+    def write_block(self, index, values, max_in_flight=batch_max_in_flight,
+                    burst=fpga_debug_codec.burst_max_words) -> list:
+        return self.run(self.write_block_op(index, values, max_in_flight, burst))
+
+    def wait_matched(self, values, mask, value) -> bool:
+        return any([(v != None) and ((v & mask) == value) for v in values])
+
+    def wait_timed_out(self, index, mask, value, timeout, polls):
+        print("ERROR: timeout after %.1fs and %d polls waiting for (cmdreg[%d] & 0x%x) == 0x%x"
+              % (timeout, polls, index, mask, value))
+        raise DebugInterfaceTimeoutError("cmdreg[%d] & 0x%x != 0x%x after %.1fs" % (index, mask, value, timeout))
+
+    def wait_until_op(self, index, mask, value, timeout, backoff, min_interval, max_interval, burst):
+        start = time.monotonic()
+        deadline = start+timeout
+        interval = min_interval
+        polls = 0
+        while(True):
+            if(burst > 1):
+                values = yield from self.read_many_op([index]*burst)
+            else:
+                values = [(yield from locked(self.read_op(index)))]
+            polls = polls+burst
+            now = time.monotonic()
+            if(self.wait_matched(values, mask, value)):
+                return (now-start, polls)
+            if(now >= deadline):
+                self.wait_timed_out(index, mask, value, timeout, polls)
+            yield ('sleep', min(interval, deadline-now))
+            interval = min(interval*backoff, max_interval)
+
+    # Poll index until (word & mask) == value.  The interval between polls
+    # starts at min_interval and is multiplied by backoff after each poll up
+    # to max_interval, so short waits finish promptly and long ones do not
+    # flood the link.  Each poll sends burst reads as one pipelined batch,
+    # which samples more often per round trip on high latency links.
+    # Returns (elapsed seconds, number of reads); raises
+    # DebugInterfaceTimeoutError if the condition is not met within timeout.
+    def wait_until(self, index, mask, value, timeout=wait_timeout, backoff=2.0,
+                   min_interval=wait_min_interval, max_interval=wait_max_interval, burst=1):
+        return self.run(self.wait_until_op(index, mask, value, timeout, backoff, min_interval, max_interval, burst))
+
+    def clear_op(self, timeout):
+        if(self.metrics != None):
+            self.metrics.resyncs = self.metrics.resyncs+1
+        yield ('clear_read_buf',)
+        r = link_resync(timeout)
+        yield ('put_bytes', resync_flush + resync_marker*resync_markers)
+        try:
+            while(not(r.done())):
+                r.put_bytes((yield ('read_available', r.wait_time())))
+        except DebugInterfaceTimeoutError:
+            self.trace_error()
+            raise
+        return r.elapsed()
+
+    # Resynchronise the link, e.g. after an error or at the start of a test:
+    # stale responses are discarded and the link drained until the resync
+    # markers have been answered (see link_resync), which is usually a few
+    # milliseconds.  Returns the time taken.  Raises
+    # DebugInterfaceTimeoutError if the markers are not answered.
+    def clear(self, timeout=resync_timeout):
+        return self.run(locked(self.clear_op(timeout)))
+
+    def end_simulation_op(self):
         if(self.sim_mode):
-            self.put_command(DebugCommand.Cmd_end_sim, 0, 0)
+            yield from self.put_command_op(DebugCommand.Cmd_end_sim, 0, 0)
+
+    def end_simulation(self):
+        return self.run(locked(self.end_simulation_op()))
+
+# asyncio version of debug_interface for driving many links from one event
+# loop, e.g.:
+#   dbg = async_debug_interface(sim=True)
+#   await dbg.write(0, 3)
+#   v = await dbg.read(0)
+# Every method that uses the link returns a coroutine since run() is one.
+# Operations on one link are serialised so that concurrent coroutines
+# sharing a link do not interleave their responses.
+class async_debug_interface(debug_interface):
+    traced_pipe_class = fpga_debug_trace.async_traced_pipe
+
+    def __init__(self, sim=True, cable_name = None, device_nr = -1, instance_nr = -1, metrics = False, trace = False,
+                 transport = None, pipe_dir = None):
+        self.sim_mode = sim
+        if(transport != None):
+            self.pipe = fpga_debug_transport.open_transport(transport, asynchronous=True)
+            simulation = fpga_debug_transport.is_simulation(transport)
+            self.sim_mode = sim if(simulation == None) else simulation
+        elif(sim):
+            self.pipe = fpga_debug_transport.transport_module('sim').async_pipe_interface(path = pipe_dir)
+        else:
+            self.pipe = fpga_debug_transport.transport_module('jtag').async_pipe_interface(
+                cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr)
+        self.commands_sent = 0
+        self.recorder = None
+        self.burst_support = None
+        self.enable_metrics(metrics)
+        self.enable_trace(trace)
+        self.lock = asyncio.Lock()
+
+    def close(self):
+        self.pipe.close()
+
+    async def run(self, op):
+        result = None
+        while(True):
+            try:
+                request = op.send(result)
+            except StopIteration as e:
+                return e.value
+            result = await self.perform(request)
+
+    # A transaction holds the lock so that command_time and the responses
+    # belong to whoever sent the commands
+    async def perform(self, request):
+        if(request[0] == 'locked'):
+            async with self.lock:
+                return await self.run(request[1])
+        if(request[0] == 'sleep'):
+            await asyncio.sleep(request[1])
+            return None
+        return await getattr(self.pipe, request[0])(*request[1:])
 
 class DebugInterfaceChecksumError(Exception):
     pass
+
+class DebugInterfaceBlockError(Exception):
+    pass
+
+class DebugInterfaceTimeoutError(Exception):
+    pass
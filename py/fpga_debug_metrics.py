@@ -0,0 +1,150 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Link instrumentation for debug_interface
+#
+# Enabled with debug_interface(..., metrics=True), after which dbg.metrics
+# holds a link_metrics.  When disabled dbg.metrics and dbg.pipe.metrics are
+# None and the only cost in the hot path is checking for that.  Example:
+#   dbg = fpga_debug_interface.debug_interface(sim=True, metrics=True)
+#   ...
+#   print(dbg.metrics.to_json())
+
+import json
+import time
+
+# Histogram of durations with power-of-two microsecond buckets: bucket k
+# counts durations d with 2^(k-1) <= d/1us < 2^k (bucket 0 is under 1us)
+class histogram:
+    num_buckets = 32
+
+    def __init__(self):
+        self.buckets = [0] * histogram.num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        k = min(int(seconds*1e6).bit_length(), histogram.num_buckets-1)
+        self.buckets[k] = self.buckets[k]+1
+        self.count = self.count+1
+        self.total = self.total+seconds
+        if(seconds > self.max):
+            self.max = seconds
+
+    # Upper bound of bucket k in seconds
+    @staticmethod
+    def bucket_limit(k) -> float:
+        return (1<<k)*1e-6
+
+    def as_dict(self) -> dict:
+        return {'count': self.count,
+                'sum_s': self.total,
+                'mean_s': self.total/self.count if(self.count>0) else 0.0,
+                'max_s': self.max,
+                'buckets': dict([("le_%gs" % (histogram.bucket_limit(k)), self.buckets[k])
+                                 for k in range(histogram.num_buckets) if(self.buckets[k]>0)])}
+
+class link_metrics:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.commands = {}
+        self.responses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.checksum_failures = 0  # bad checksums on responses seen by the host
+        self.timeouts = 0
+        self.resyncs = 0
+        self.latency = histogram()  # command sent to response received
+        self.wait = histogram()     # time spent waiting for data in get_bytes
+
+    # Called by the pipe interfaces
+    def sent(self, nbytes):
+        self.bytes_sent = self.bytes_sent+nbytes
+
+    def received(self, nbytes, waited):
+        self.bytes_received = self.bytes_received+nbytes
+        if(waited > 0):
+            self.wait.add(waited)
+
+    def timed_out(self):
+        self.timeouts = self.timeouts+1
+
+    def count_command(self, cmd, n=1):
+        self.commands[cmd.name] = self.commands.get(cmd.name, 0)+n
+
+    def count_response(self, code):
+        self.responses[code.name] = self.responses.get(code.name, 0)+1
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic()-self.start
+        return {'elapsed_s': elapsed,
+                'commands': dict(self.commands),
+                'responses': dict(self.responses),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'commands_per_s': sum(self.commands.values())/elapsed if(elapsed>0) else 0.0,
+                'checksum_failures': self.checksum_failures,
+                'timeouts': self.timeouts,
+                'resyncs': self.resyncs,
+                'latency': self.latency.as_dict(),
+                'wait': self.wait.as_dict()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix='fpga_debug', labels='') -> str:
+        lines = []
+        def metric(name, kind, samples):
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for (extra, value) in samples:
+                l = ",".join([x for x in (labels, extra) if(x!='')])
+                lines.append("%s_%s%s %s" % (prefix, name, "{%s}" % (l) if(l!='') else "", repr(value)))
+        metric("commands_total", "counter", [('command="%s"' % (c), n) for (c, n) in sorted(self.commands.items())])
+        metric("responses_total", "counter", [('code="%s"' % (c), n) for (c, n) in sorted(self.responses.items())])
+        metric("bytes_sent_total", "counter", [('', self.bytes_sent)])
+        metric("bytes_received_total", "counter", [('', self.bytes_received)])
+        metric("checksum_failures_total", "counter", [('', self.checksum_failures)])
+        metric("timeouts_total", "counter", [('', self.timeouts)])
+        metric("resyncs_total", "counter", [('', self.resyncs)])
+        for (name, h) in (("latency_seconds", self.latency), ("wait_seconds", self.wait)):
+            samples = []
+            cumulative = 0
+            for k in range(histogram.num_buckets):
+                cumulative = cumulative+h.buckets[k]
+                samples.append(('le="%g"' % (histogram.bucket_limit(k)), cumulative))
+            samples.append(('le="+Inf"', h.count))
+            lines.append("# TYPE %s_%s histogram" % (prefix, name))
+            for (extra, value) in samples:
+                l = ",".join([x for x in (labels, extra) if(x!='')])
+                lines.append("%s_%s_bucket{%s} %d" % (prefix, name, l, value))
+            l = "{%s}" % (labels) if(labels!='') else ""
+            lines.append("%s_%s_sum%s %s" % (prefix, name, l, repr(h.total)))
+            lines.append("%s_%s_count%s %d" % (prefix, name, l, h.count))
+        return "\n".join(lines)+"\n"
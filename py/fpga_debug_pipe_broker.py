@@ -0,0 +1,130 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Library to use the hardware FPGADebugInterface via a link_broker.py daemon
+#
+# The broker owns the link to the FPGA (or simulation) and shares it between
+# clients over a Unix-domain socket.  Clients send command packets exactly
+# as they would to the link and receive the responses to their own commands.
+
+import os
+import re
+import socket
+import tempfile
+import time
+from fpga_debug_ring_buffer import ring_buffer
+
+# default time in seconds to wait for a response before giving up
+default_timeout = 10.0
+
+# Default socket for the broker serving a cable, or the simulation if
+# cable_name is None
+def socket_path(cable_name=None) -> str:
+    name = "sim" if(cable_name==None) else re.sub(r'[^\w.-]+', '_', cable_name).strip('_')
+    return os.path.join(tempfile.gettempdir(), "fpga-debug-broker-%d-%s.sock" % (os.getuid(), name))
+
+class pipe_interface:
+    def __init__(self, path = None, timeout = default_timeout):
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path() if(path==None) else path)
+        self.read_buf = ring_buffer()
+        self.metrics = None
+
+    def close(self):
+        self.sock.close()
+
+    def calc_checksum(self, packet_list) -> int:
+        return (sum(packet_list) + 0x55) & 0xff
+
+    def put_bytes(self, bytes_list):
+        self.sock.settimeout(None)
+        self.sock.sendall(bytes(bytes_list))
+        if(self.metrics != None):
+            self.metrics.sent(len(bytes_list))
+
+    # Receive into the buffer, waiting at most timeout seconds (0 = don't wait)
+    def fill_read_buf(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            n = self.sock.recv_into(self.read_buf.free_views()[0])
+        except (socket.timeout, BlockingIOError):
+            return
+        if(n == 0):
+            print("Broker closed the debug channel")
+            raise PipeReadError
+        self.read_buf.commit(n)
+
+    def clear_read_buf(self):
+        self.fill_read_buf(0)
+        self.read_buf.clear()
+
+    # Return whatever has arrived, waiting up to timeout seconds for
+    # something if nothing has, or b'' if nothing did
+    def read_available(self, timeout) -> bytes:
+        if(len(self.read_buf) == 0):
+            self.fill_read_buf(timeout)
+        r = bytes(self.read_buf.read(len(self.read_buf)))
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+    def get_bytes(self, nbytes, timeout=None):
+        return self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    # Wait for at least minbytes and return up to maxbytes of whatever has
+    # arrived.  The result is a memoryview (or bytes) that is only valid
+    # until the next call.
+    def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        deadline = time.monotonic() + (self.timeout if(timeout==None) else timeout)
+        waited = 0.0
+        while(len(self.read_buf) < minbytes):
+            remaining = deadline - time.monotonic()
+            if(remaining <= 0):
+                print("Failed to read %d bytes from the broker" % (minbytes))
+                if(self.metrics != None):
+                    self.metrics.timed_out()
+                raise PipeReadError
+            start = time.monotonic()
+            self.fill_read_buf(remaining)
+            waited = waited + time.monotonic()-start
+        r = self.read_buf.read(min(len(self.read_buf), maxbytes))
+        if(self.metrics != None):
+            self.metrics.received(len(r), waited)
+        return r
+
+# broker:///path/to/socket, or broker://?cable=name for the default socket
+# of the broker serving a cable (see fpga_debug_transport)
+def open_transport(location, options, asynchronous=False):
+    if(asynchronous):
+        raise ValueError("the broker transport has no asyncio interface")
+    path = location if(location!='') else socket_path(options.get('cable'))
+    return pipe_interface(path = path, timeout = float(options.get('timeout', default_timeout)))
+
+class PipeReadError(Exception):
+    pass
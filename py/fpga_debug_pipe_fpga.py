@@ -29,41 +29,268 @@
 # Library to use the hardware FPGADebugInterface via Jtag Atlantic on FPGA
 
 import intel_jtag_uart
+import threading
 import time
-from functools import reduce
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from fpga_debug_ring_buffer import ring_buffer, async_ring_buffer
+
+# default time in seconds to wait for a response before giving up
+default_timeout = 10.0
+# longest sleep between polls of the JTAG UART when nothing has arrived
+max_poll_interval = 0.01
+# sleep between polls by the background reader thread when the UART is idle
+reader_poll_interval = 0.0005
+# largest write made while holding the UART, so that the asyncio poller can
+# drain responses in between (the size of the JTAG UART FIFO)
+async_write_chunk = 64
 
 class pipe_interface:
-    def __init__(self, cable_name = None, device_nr = -1, instance_nr = -1):
+    # With reader_thread=True a background thread continuously drains the
+    # JTAG UART into the receive buffer, so the on-chip FIFO never fills
+    # while the host is busy, and get_bytes() is woken as soon as data
+    # arrives.  Otherwise the UART is only polled from get_bytes().
+    def __init__(self, cable_name = None, device_nr = -1, instance_nr = -1, reader_thread = False, timeout = default_timeout):
         # print("DEBUG: cable_name=%s, device_nr=%d, instance_nr=%d"%("None" if cable_name==None else cable_name,device_nr,instance_nr))
         self.uart = intel_jtag_uart.intel_jtag_uart(cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr)
-        self.read_buf = list()
+        self.timeout = timeout
+        self.read_buf = ring_buffer()
+        self.uart_lock = threading.Lock()
+        self.read_ready = threading.Condition()
+        self.reader = None
+        self.metrics = None
+        if(reader_thread):
+            self.start_reader()
+
+    def start_reader(self):
+        if(self.reader == None):
+            self.reader_stop = threading.Event()
+            self.reader = threading.Thread(target=self.reader_loop, name="jtag_uart_reader", daemon=True)
+            self.reader.start()
+
+    def stop_reader(self):
+        if(self.reader != None):
+            self.reader_stop.set()
+            self.reader.join()
+            self.reader = None
+
+    def reader_loop(self):
+        while(not(self.reader_stop.is_set())):
+            new_bytes = self.read_uart()
+            if(len(new_bytes) > 0):
+                with self.read_ready:
+                    self.read_buf.write(new_bytes)
+                    self.read_ready.notify_all()
+            else:
+                self.reader_stop.wait(reader_poll_interval)
+
+    def read_uart(self) -> bytes:
+        with self.uart_lock:
+            if(self.uart.bytes_available()>0):
+                return self.uart.read()
+        return b''
 
     def calc_checksum(self, packet_list) -> int:
-        return reduce(lambda a,b: a+b, packet_list + [0x55,0x00]) & 0xff
+        return (sum(packet_list) + 0x55) & 0xff
     
     def put_bytes(self, bytes_list):
-        self.uart.write(bytes(bytes_list))
+        with self.uart_lock:
+            self.uart.write(bytes(bytes_list))
+        if(self.metrics != None):
+            self.metrics.sent(len(bytes_list))
 
-    def get_bytes(self, nbytes):
-        try_read = 1000
-        while((len(self.read_buf) < nbytes) and (try_read>0)):
-            try_read = try_read-1
-            if(self.uart.bytes_available()>0):
-                new_bytes = list(self.uart.read())
-                self.read_buf = self.read_buf + new_bytes
-                try_read = -1
-            else:
-                time.sleep(0.1 if try_read<20 else 0.01)
-        if(len(self.read_buf) >= nbytes):
-            r = self.read_buf[0:nbytes]
-            self.read_buf = self.read_buf[nbytes:]
-            return r
+    def deadline(self, timeout):
+        return time.monotonic() + (self.timeout if(timeout==None) else timeout)
+
+    # Returns a memoryview (or bytes if the data wraps around the receive
+    # buffer) that is only valid until the next call to get_bytes().  When
+    # the reader thread is running a copy is returned since the thread may
+    # reuse the buffer at any time.
+    def get_bytes(self, nbytes, timeout=None):
+        return self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    # As get_bytes() but waits only for minbytes and then returns up to
+    # maxbytes of whatever has already arrived
+    def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        if(self.reader != None):
+            return self.get_bytes_threaded(minbytes, maxbytes, timeout)
+        nbytes = minbytes
+        deadline = None
+        waited = 0.0
+        interval = reader_poll_interval
+        while(len(self.read_buf) < nbytes):
+            new_bytes = self.read_uart()
+            if(len(new_bytes) > 0):
+                self.read_buf.write(new_bytes)
+                interval = reader_poll_interval
+                continue
+            if(deadline == None):
+                deadline = self.deadline(timeout)
+            remaining = deadline - time.monotonic()
+            if(remaining <= 0):
+                if(self.metrics != None):
+                    self.metrics.timed_out()
+                raise PipeReadError
+            time.sleep(min(interval, remaining))
+            waited = waited + min(interval, remaining)
+            interval = min(interval*2, max_poll_interval)
+        r = self.read_buf.read(min(len(self.read_buf), maxbytes))
+        if(self.metrics != None):
+            self.metrics.received(len(r), waited)
+        return r
+
+    def get_bytes_threaded(self, minbytes, maxbytes, timeout):
+        deadline = self.deadline(timeout)
+        waited = 0.0
+        with self.read_ready:
+            while(len(self.read_buf) < minbytes):
+                remaining = deadline - time.monotonic()
+                if(remaining <= 0):
+                    if(self.metrics != None):
+                        self.metrics.timed_out()
+                    raise PipeReadError
+                start = time.perf_counter()
+                self.read_ready.wait(remaining)
+                waited = waited + time.perf_counter()-start
+            r = bytes(self.read_buf.read(min(len(self.read_buf), maxbytes)))
+        if(self.metrics != None):
+            self.metrics.received(len(r), waited)
+        return r
+
+    # Discard everything received so far
+    def clear_read_buf(self):
+        with self.read_ready:
+            while(len(self.read_uart()) > 0):
+                pass
+            self.read_buf.clear()
+
+    # Return whatever has arrived, waiting up to timeout seconds for
+    # something if nothing has, or b'' if nothing did
+    def read_available(self, timeout) -> bytes:
+        if(self.reader != None):
+            with self.read_ready:
+                if(len(self.read_buf) == 0):
+                    self.read_ready.wait(timeout)
+                r = bytes(self.read_buf.read(len(self.read_buf)))
         else:
+            deadline = self.deadline(timeout)
+            interval = reader_poll_interval
+            while(True):
+                self.read_buf.write(self.read_uart())
+                remaining = deadline - time.monotonic()
+                if((len(self.read_buf) > 0) or (remaining <= 0)):
+                    break
+                time.sleep(min(interval, remaining))
+                interval = min(interval*2, max_poll_interval)
+            r = bytes(self.read_buf.read(len(self.read_buf)))
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+# asyncio version of pipe_interface.  intel_jtag_uart calls block, so each
+# link has a worker thread that a poller task uses to drain the UART into the
+# receive buffer and another for writes, which are split into chunks so that
+# a slow write does not hold up receiving; any number of links can share one
+# event loop.  If the poller fails, its exception is logged and raised to
+# every later read.  Opening the UART (in the constructor) blocks as for
+# pipe_interface.
+class async_pipe_interface(pipe_interface):
+    def __init__(self, cable_name = None, device_nr = -1, instance_nr = -1, timeout = default_timeout):
+        super().__init__(cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr, timeout = timeout)
+        self.read_buf = async_ring_buffer()
+        self.reader_executor = ThreadPoolExecutor(max_workers=1)
+        self.writer_executor = ThreadPoolExecutor(max_workers=1)
+        self.poller = None
+
+    def attach(self):
+        if(self.poller == None):
+            self.poller = asyncio.get_running_loop().create_task(self.poll_uart())
+            self.poller.add_done_callback(self.poller_done)
+
+    def poller_done(self, task):
+        if(task.cancelled()):
+            return
+        e = task.exception()
+        if(e != None):
+            print("ERROR: JTAG UART poller failed: %s" % (repr(e)))
+            error = PipeReadError("JTAG UART poller failed: %s" % (repr(e)))
+            error.__cause__ = e
+            self.read_buf.fail(error)
+
+    def close(self):
+        if(self.poller != None):
+            self.poller.cancel()
+            self.poller = None
+        self.reader_executor.shutdown(wait=False)
+        self.writer_executor.shutdown(wait=False)
+
+    async def poll_uart(self):
+        loop = asyncio.get_running_loop()
+        interval = reader_poll_interval
+        while(True):
+            new_bytes = await loop.run_in_executor(self.reader_executor, self.read_uart)
+            if(len(new_bytes) > 0):
+                self.read_buf.write(new_bytes)
+                interval = reader_poll_interval
+            else:
+                await asyncio.sleep(interval)
+                interval = min(interval*2, max_poll_interval)
+
+    def write_uart(self, data):
+        for off in range(0, len(data), async_write_chunk):
+            with self.uart_lock:
+                self.uart.write(data[off:off+async_write_chunk])
+
+    async def put_bytes(self, bytes_list):
+        self.attach()
+        data = bytes(bytes_list)
+        await asyncio.get_running_loop().run_in_executor(self.writer_executor, self.write_uart, data)
+        if(self.metrics != None):
+            self.metrics.sent(len(data))
+
+    # Drain the UART through the poller's worker, so that nothing it has
+    # already read can land in the buffer after it is cleared
+    async def clear_read_buf(self):
+        self.attach()
+        loop = asyncio.get_running_loop()
+        while(len(await loop.run_in_executor(self.reader_executor, self.read_uart)) > 0):
+            pass
+        self.read_buf.clear()
+
+    async def read_available(self, timeout) -> bytes:
+        self.attach()
+        r = await self.read_buf.read_available(timeout)
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+    async def get_bytes(self, nbytes, timeout=None):
+        return await self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    async def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        self.attach()
+        start = time.perf_counter()
+        try:
+            r = await self.read_buf.read_wait(minbytes, self.timeout if(timeout==None) else timeout, maxbytes)
+        except asyncio.TimeoutError:
+            if(self.metrics != None):
+                self.metrics.timed_out()
             raise PipeReadError
+        if(self.metrics != None):
+            self.metrics.received(len(r), time.perf_counter()-start)
+        return r
+
+# jtag://cable_name?device=n&instance=n&reader_thread=1&timeout=seconds
+# (see fpga_debug_transport)
+def open_transport(location, options, asynchronous=False):
+    cable_name = location if(location!='') else None
+    device_nr = int(options.get('device', -1))
+    instance_nr = int(options.get('instance', -1))
+    timeout = float(options.get('timeout', default_timeout))
+    if(asynchronous):
+        return async_pipe_interface(cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr, timeout = timeout)
+    return pipe_interface(cable_name = cable_name, device_nr = device_nr, instance_nr = instance_nr,
+                          reader_thread = options.get('reader_thread', '0') not in ('0', 'false'), timeout = timeout)
 
-    def clear_read_buf(self):
-        while(self.uart.bytes_available()>0):
-            b = self.get_bytes(self.uart_bytes_available())
-        
 class PipeReadError(Exception):
     pass
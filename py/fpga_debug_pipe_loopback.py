@@ -0,0 +1,200 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# In-process model of FPGADebugInterface as a transport
+#
+# pipe_interface models mkFPGADebugInterface in bsv/FPGADebugInterface.bsv
+# connected to a device under test written in Python, so the host library
+# runs without an FPGA or simulator, e.g.:
+#   dbg = fpga_debug_interface.debug_interface(loopback=True)
+# The model follows the hardware: zero bytes between packets are skipped,
+# packets with a bad checksum are answered with Rsp_checksum_fail, writes
+# are acknowledged with Rsp_write_ack as they are received, read data is
+# sent in preference to response codes and Cmd_end_sim stops the model.
+# The FIFOs are unbounded and the model only runs when the host sends
+# bytes, so a read that cannot be satisfied fails immediately.  Write and
+# read bursts are passed to the device under test as Cmd_write_word and
+# Cmd_read_word requests, as the hardware does.
+#
+# The device under test is any callable dut(cmd, index, data) taking the
+# command code and 8-bit index and 64-bit data of each valid request, and
+# returning a 64-bit word to send back as Rsp_read_data or None.
+
+import fpga_debug_codec
+from fpga_debug_codec import command_packet, command_packet_size, checksum_init
+from fpga_debug_ring_buffer import ring_buffer
+from collections import deque
+import struct
+
+CMD_NOP = 0
+CMD_WRITE_WORD = 2
+CMD_READ_WORD = 3
+CMD_END_SIM = 254
+RSP_WRITE_ACK = 2
+RSP_CHECKSUM_FAIL = 254
+RSP_INVALID = 255
+
+read_data_header = struct.Struct(">BQ")
+
+# Python version of the register file in
+# tests/fpgadebuginterface/tstFPGADebugInterface.bsv: indices 0..3 write and
+# read the registers, writes to indices 4..7 add to registers 0..3
+class register_file:
+    def __init__(self, size=4):
+        self.rf = [0] * size
+
+    def __call__(self, cmd, index, data):
+        size = len(self.rf)
+        if(cmd == CMD_WRITE_WORD):
+            if(index < size):
+                self.rf[index] = data
+            elif(index < size*2):
+                self.rf[index-size] = (self.rf[index-size] + data) & 0xffffffffffffffff
+            else:
+                print("ERROR: invalid index %1d on write" % (index))
+        elif(cmd == CMD_READ_WORD):
+            if(index < size):
+                return self.rf[index]
+            print("ERROR: invalid index %1d on read" % (index))
+        else:
+            print("ERROR: command %1d not handled" % (cmd))
+        return None
+
+class pipe_interface:
+    def __init__(self, dut = None):
+        self.dut = register_file() if(dut==None) else dut
+        self.rx = bytearray()           # bytes of a partly received packet
+        self.debug_response = deque()   # read data from the DUT, a list of words for a read burst
+        self.response_code = deque()
+        self.read_buf = ring_buffer()
+        self.finished = False
+        self.metrics = None
+
+    def calc_checksum(self, packet_list) -> int:
+        return (sum(packet_list) + checksum_init) & 0xff
+
+    def put_bytes(self, bytes_list):
+        if(self.metrics != None):
+            self.metrics.sent(len(bytes_list))
+        if(self.finished):
+            return
+        buf = self.rx + bytes(bytes_list)
+        n = len(buf)
+        off = 0
+        while(True):
+            while((off < n) and (buf[off] == CMD_NOP)):
+                off = off+1
+            if(n-off < command_packet_size):
+                break
+            (cmd, index, data, checksum) = command_packet.unpack_from(buf, off)
+            end = off+command_packet_size
+            is_burst = (cmd == fpga_debug_codec.CMD_WRITE_BURST) or (cmd == fpga_debug_codec.CMD_READ_BURST)
+            if(((sum(buf[off:end-1]) + checksum_init) & 0xff) != checksum):
+                self.response_code.append(RSP_CHECKSUM_FAIL)
+            elif(is_burst and ((data < 1) or (data > fpga_debug_codec.burst_max_words))):
+                self.response_code.append(RSP_INVALID)
+            elif(cmd == fpga_debug_codec.CMD_WRITE_BURST):
+                payload_end = end+data*8
+                if(n < payload_end+1):
+                    break  # wait for the rest of the burst
+                if(((sum(buf[end:payload_end]) + checksum_init) & 0xff) != buf[payload_end]):
+                    self.response_code.append(RSP_CHECKSUM_FAIL)
+                else:
+                    self.response_code.append(fpga_debug_codec.RSP_WRITE_BURST_ACK)
+                    for word in fpga_debug_codec.decode_words(buf[end:payload_end]):
+                        self.dut(CMD_WRITE_WORD, index, word)
+                end = payload_end+1
+            elif(cmd == fpga_debug_codec.CMD_READ_BURST):
+                # the hardware always returns N words, so reads the model
+                # does not answer come back as zero
+                words = [self.dut(CMD_READ_WORD, index, 0) for j in range(data)]
+                self.debug_response.append([0 if(w == None) else w for w in words])
+            else:
+                if(cmd == CMD_WRITE_WORD):
+                    self.response_code.append(RSP_WRITE_ACK)
+                if(cmd == CMD_END_SIM):
+                    self.finished = True
+                    break
+                rsp = self.dut(cmd, index, data)
+                if(rsp != None):
+                    self.debug_response.append(rsp)
+            off = end
+        self.rx = bytearray(buf[off:]) if(not(self.finished)) else bytearray()
+
+    # Move queued responses into the receive buffer, read data first
+    def transmit(self):
+        while(self.debug_response):
+            rsp = self.debug_response.popleft()
+            if(isinstance(rsp, list)):
+                packet = bytes((fpga_debug_codec.RSP_READ_BURST_DATA,)) + fpga_debug_codec.encode_words(rsp)
+            else:
+                packet = read_data_header.pack(fpga_debug_codec.RSP_READ_DATA, rsp)
+            self.read_buf.write(packet + bytes(((sum(packet) + checksum_init) & 0xff,)))
+        while(self.response_code):
+            code = self.response_code.popleft()
+            self.read_buf.write(bytes((code, (code + checksum_init) & 0xff)))
+
+    def clear_read_buf(self):
+        self.debug_response.clear()
+        self.response_code.clear()
+        self.read_buf.clear()
+
+    # The timeout is ignored as for get_bytes_upto()
+    def read_available(self, timeout) -> bytes:
+        self.transmit()
+        r = bytes(self.read_buf.read(len(self.read_buf)))
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+    def get_bytes(self, nbytes, timeout=None):
+        return self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    # Returns at least minbytes and up to maxbytes as a memoryview (or bytes)
+    # that is only valid until the next call.  The timeout is ignored since
+    # no more responses can arrive until more commands are sent.
+    def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        self.transmit()
+        if(len(self.read_buf) < minbytes):
+            print("Failed to read %d bytes over the debug channel" % (minbytes))
+            if(self.metrics != None):
+                self.metrics.timed_out()
+            raise PipeReadError
+        r = self.read_buf.read(min(len(self.read_buf), maxbytes))
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+# loopback:// with the register_file DUT (see fpga_debug_transport)
+def open_transport(location, options, asynchronous=False):
+    if(asynchronous):
+        raise ValueError("the loopback transport has no asyncio interface")
+    return pipe_interface()
+
+class PipeReadError(Exception):
+    pass
@@ -30,65 +30,222 @@
 
 import os
 import fcntl
+import select
 import time
-from functools import reduce
+import asyncio
+from fpga_debug_ring_buffer import ring_buffer, async_ring_buffer
 
 # default pipe FIFO names in the file system
 FIFO_PY2V = 'bytepipe-host2hw'
 FIFO_V2PY = 'bytepipe-hw2host'
 
+# environment variable giving the directory holding the pipes when none is
+# given (set by parallel_test_runner.py for each simulator it runs); the
+# default is the current directory
+PIPE_DIR_ENV = 'FPGA_DEBUG_PIPE_DIR'
+
+# default time in seconds to wait for the simulator before giving up
+default_timeout = 20.0
+
 class pipe_interface:
-    def __init__(self):
-        self.fifo_tx = open(FIFO_PY2V,'wb')
-        self.fifo_rx = open(FIFO_V2PY,'rb', buffering=0)
-        fd_rx = self.fifo_rx.fileno()
-        flag_rx = fcntl.fcntl(fd_rx, fcntl.F_GETFL)
-        fcntl.fcntl(fd_rx, fcntl.F_SETFL, flag_rx | os.O_NONBLOCK | os.O_ASYNC)
-        fd_tx = self.fifo_tx.fileno()
-        flag_tx = fcntl.fcntl(fd_tx, fcntl.F_GETFL)
-        fcntl.fcntl(fd_tx, fcntl.F_SETFL, flag_tx | os.O_NONBLOCK | os.O_ASYNC)
+    # path is the directory holding the pipes (see PIPE_DIR_ENV)
+    def __init__(self, timeout=default_timeout, path=None):
+        self.timeout = timeout
+        path = os.environ.get(PIPE_DIR_ENV) if(path==None) else path
+        self.fifo_tx = open(FIFO_PY2V if(path==None) else os.path.join(path, FIFO_PY2V),'wb')
+        self.fifo_rx = open(FIFO_V2PY if(path==None) else os.path.join(path, FIFO_V2PY),'rb', buffering=0)
+        self.fd_rx = self.fifo_rx.fileno()
+        flag_rx = fcntl.fcntl(self.fd_rx, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd_rx, fcntl.F_SETFL, flag_rx | os.O_NONBLOCK)
+        self.fd_tx = self.fifo_tx.fileno()
+        flag_tx = fcntl.fcntl(self.fd_tx, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd_tx, fcntl.F_SETFL, flag_tx | os.O_NONBLOCK)
+        self.poll_rx = select.poll()
+        self.poll_rx.register(self.fd_rx, select.POLLIN)
+        self.poll_tx = select.poll()
+        self.poll_tx.register(self.fd_tx, select.POLLOUT)
+        self.read_buf = ring_buffer()
+        self.metrics = None
 
     def calc_checksum(self, packet_list) -> int:
-        return reduce(lambda a,b: a+b, packet_list + [0x55,0x00]) & 0xff
-    
-    def put_bytes(self, bytes_list):
-        b = bytes(bytes_list)
-        self.fifo_tx.write(b)
-        self.fifo_tx.flush()
-        
-    def __get_byte_async(self):
-        return self.fifo_rx.read(1)  # async read
+        return (sum(packet_list) + 0x55) & 0xff
+
+    def deadline(self, timeout):
+        return time.monotonic() + (self.timeout if(timeout==None) else timeout)
+
+    # Wait on poller until the fd is ready or the deadline passes
+    def wait(self, poller, deadline) -> bool:
+        remaining = deadline - time.monotonic()
+        if(remaining <= 0):
+            return False
+        return len(poller.poll(remaining*1000)) > 0
+
+    def put_bytes(self, bytes_list, timeout=None):
+        b = memoryview(bytes(bytes_list))
+        deadline = self.deadline(timeout)
+        while(len(b) > 0):
+            try:
+                n = os.write(self.fd_tx, b)
+                b = b[n:]
+            except BlockingIOError:
+                if(not(self.wait(self.poll_tx, deadline))):
+                    print("Failed to write to the debug channel")
+                    raise PipeWriteError
+        if(self.metrics != None):
+            self.metrics.sent(len(bytes_list))
+
+    # Read whatever the simulator has sent straight into the receive buffer.
+    # Returns the number of bytes read, or -1 if the simulator closed the pipe.
+    def fill_read_buf(self) -> int:
+        try:
+            n = os.readv(self.fd_rx, self.read_buf.free_views())
+        except BlockingIOError:
+            return 0
+        if(n == 0):
+            return -1
+        self.read_buf.commit(n)
+        return n
 
+    # Discard everything received so far
     def clear_read_buf(self):
-        for try_read in range(100):
-            c = self.__get_byte_async()
-            time.sleep(0.01)
-        
-    def __get_byte(self):
-        try_read = 1000
-        c=None
-        while(try_read>0):
-            c = self.__get_byte_async()
-            if(c!=None):
-                b = int.from_bytes(c,"little")
-                try_read = -1
-            else:
-                try_read = try_read-1;
-                if(try_read<100):
-                    time.sleep(0.1)
-                else:
-                    time.sleep(0.01)
-        if(c==None):
-            print("Failed to read a byte over the debug channel")
+        while(self.fill_read_buf() > 0):
+            self.read_buf.clear()
+        self.read_buf.clear()
+
+    # Return whatever has arrived, waiting up to timeout seconds for
+    # something if nothing has, or b'' if nothing did
+    def read_available(self, timeout) -> bytes:
+        if((len(self.read_buf) == 0) and (self.fill_read_buf() == 0) and self.wait(self.poll_rx, self.deadline(timeout))):
+            self.fill_read_buf()
+        r = bytes(self.read_buf.read(len(self.read_buf)))
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+    # Returns as soon as nbytes have arrived.  The result is a memoryview (or
+    # bytes if the data wraps around the receive buffer) that is only valid
+    # until the next call to get_bytes().
+    def get_bytes(self, nbytes, timeout=None):
+        return self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    # As get_bytes() but waits only for minbytes and then returns up to
+    # maxbytes of whatever has already arrived
+    def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        nbytes = minbytes
+        deadline = None
+        waited = 0.0
+        if(len(self.read_buf) < maxbytes):
+            self.fill_read_buf()
+        while(len(self.read_buf) < nbytes):
+            if(self.fill_read_buf() < 0):
+                print("Simulator closed the debug channel")
+                raise PipeReadError
+            if(len(self.read_buf) >= nbytes):
+                break
+            if(deadline == None):
+                deadline = self.deadline(timeout)
+            start = time.perf_counter()
+            ready = self.wait(self.poll_rx, deadline)
+            waited = waited + time.perf_counter()-start
+            if(not(ready) and (time.monotonic() >= deadline)):
+                print("Failed to read %d bytes over the debug channel" % (nbytes))
+                if(self.metrics != None):
+                    self.metrics.timed_out()
+                raise PipeReadError
+        r = self.read_buf.read(min(len(self.read_buf), maxbytes))
+        if(self.metrics != None):
+            self.metrics.received(len(r), waited)
+        return r
+
+# asyncio version of pipe_interface.  The receive FIFO is watched with an
+# event loop reader so any number of pipes can be serviced by one loop.
+# Opening the FIFOs blocks until the simulator has opened them, as for
+# pipe_interface.
+class async_pipe_interface(pipe_interface):
+    def __init__(self, timeout=default_timeout, path=None):
+        super().__init__(timeout, path)
+        self.read_buf = async_ring_buffer()
+        self.loop = None
+
+    def attach(self):
+        if(self.loop == None):
+            self.loop = asyncio.get_running_loop()
+            self.loop.add_reader(self.fd_rx, self.on_readable)
+
+    def close(self):
+        if(self.loop != None):
+            self.loop.remove_reader(self.fd_rx)
+            self.loop = None
+
+    def on_readable(self):
+        if(self.fill_read_buf() < 0):
+            self.close()
+            self.read_buf.fail(PipeReadError("Simulator closed the debug channel"))
+
+    async def put_bytes(self, bytes_list, timeout=None):
+        self.attach()
+        b = memoryview(bytes(bytes_list))
+        deadline = self.deadline(timeout)
+        while(len(b) > 0):
+            try:
+                n = os.write(self.fd_tx, b)
+                b = b[n:]
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd_tx, writable.set_result, None)
+                try:
+                    await asyncio.wait_for(writable, max(0, deadline-time.monotonic()))
+                except asyncio.TimeoutError:
+                    print("Failed to write to the debug channel")
+                    raise PipeWriteError
+                finally:
+                    self.loop.remove_writer(self.fd_tx)
+        if(self.metrics != None):
+            self.metrics.sent(len(bytes_list))
+
+    async def clear_read_buf(self):
+        self.attach()
+        self.read_buf.clear()
+
+    async def read_available(self, timeout) -> bytes:
+        self.attach()
+        r = await self.read_buf.read_available(timeout)
+        if(self.metrics != None):
+            self.metrics.received(len(r), 0.0)
+        return r
+
+    async def get_bytes(self, nbytes, timeout=None):
+        return await self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    async def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        self.attach()
+        start = time.perf_counter()
+        try:
+            r = await self.read_buf.read_wait(minbytes, self.timeout if(timeout==None) else timeout, maxbytes)
+        except asyncio.TimeoutError:
+            print("Failed to read %d bytes over the debug channel" % (minbytes))
+            if(self.metrics != None):
+                self.metrics.timed_out()
             raise PipeReadError
-        i = int.from_bytes(c,"little")
-        return i
+        if(self.metrics != None):
+            self.metrics.received(len(r), time.perf_counter()-start)
+        return r
+
+# sim:///path/to/pipes?timeout=seconds (see fpga_debug_transport)
+def open_transport(location, options, asynchronous=False):
+    timeout = float(options.get('timeout', default_timeout))
+    path = location if(location!='') else None
+    return (async_pipe_interface if(asynchronous) else pipe_interface)(timeout=timeout, path=path)
 
-    def get_bytes(self, nbytes):
-        packet_list = []
-        for j in range(nbytes):
-            packet_list.append(self.__get_byte())
-        return packet_list
+# Create the pipes in a directory for a simulator to be run there
+def make_pipes(path):
+    for name in (FIFO_PY2V, FIFO_V2PY):
+        if(os.path.exists(os.path.join(path, name))):
+            os.remove(os.path.join(path, name))
+        os.mkfifo(os.path.join(path, name))
 
 class PipeReadError(Exception):
     pass
+
+class PipeWriteError(Exception):
+    pass
@@ -0,0 +1,177 @@
+# Copyright (c) 2021 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Byte ring buffer for the receive side of the pipe interfaces
+#
+# Received bytes are copied once into a preallocated bytearray.  Reads return
+# a memoryview into that bytearray when the requested bytes are contiguous
+# (the common case, since the buffer rewinds whenever it empties), so no
+# further copying takes place.  A memoryview returned by read() is only valid
+# until the next write(); callers that need to keep the bytes should copy
+# them with bytes().
+
+import asyncio
+
+class ring_buffer:
+    def __init__(self, capacity=4096):
+        size = 1
+        while(size < capacity):
+            size = size<<1
+        self.allocate(size)
+        self.head = 0
+        self.count = 0
+
+    def allocate(self, size):
+        self.size = size
+        self.mask = size-1
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def __len__(self):
+        return self.count
+
+    def free(self) -> int:
+        return self.size-self.count
+
+    # Double the buffer until nbytes will fit.  A new bytearray is allocated
+    # so memoryviews already handed out by read() remain valid.
+    def grow(self, nbytes):
+        size = self.size
+        while(size < nbytes):
+            size = size<<1
+        old = self.read(self.count)
+        self.allocate(size)
+        self.view[0:len(old)] = old
+        self.head = 0
+        self.count = len(old)
+
+    def write(self, data):
+        n = len(data)
+        if(n > self.free()):
+            self.grow(self.count+n)
+        tail = (self.head+self.count) & self.mask
+        first = min(n, self.size-tail)
+        self.view[tail:tail+first] = data[0:first]
+        if(first < n):
+            self.view[0:n-first] = data[first:n]
+        self.count = self.count+n
+
+    # Free space as up to two writable memoryviews, for use with os.readv()
+    # and similar so received data lands directly in the buffer.  Call
+    # commit() afterwards with the number of bytes actually written.
+    def free_views(self) -> list:
+        if(self.free() == 0):
+            self.grow(self.size<<1)
+        tail = (self.head+self.count) & self.mask
+        if((self.count == 0) or (tail > self.head)):
+            views = [self.view[tail:self.size]]
+            if(self.head > 0):
+                views.append(self.view[0:self.head])
+            return views
+        return [self.view[tail:self.head]]
+
+    def commit(self, nbytes):
+        self.count = self.count+nbytes
+
+    # Remove and return nbytes from the front of the buffer.  Returns a
+    # memoryview without copying unless the bytes wrap around the end of the
+    # buffer, in which case a bytes copy is returned.
+    def read(self, nbytes):
+        if(nbytes > self.count):
+            raise IndexError("ring_buffer.read(%d) with only %d bytes available" % (nbytes, self.count))
+        start = self.head
+        end = start+nbytes
+        if(end <= self.size):
+            r = self.view[start:end]
+        else:
+            r = bytes(self.view[start:self.size]) + bytes(self.view[0:end-self.size])
+        self.count = self.count-nbytes
+        # rewind when empty so the next read is contiguous
+        self.head = 0 if(self.count == 0) else (end & self.mask)
+        return r
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+
+# A ring_buffer that a coroutine can wait on.  Event loop callbacks add data
+# with write() or free_views()/commit(), which wake a coroutine waiting in
+# read_wait() once enough bytes have arrived.  There is at most one waiting
+# reader per buffer.
+class async_ring_buffer(ring_buffer):
+    def __init__(self, capacity=4096):
+        super().__init__(capacity)
+        self.waiter = None
+        self.waiting_for = 0
+        self.error = None
+
+    def wake_reader(self):
+        if((self.waiter != None) and not(self.waiter.done())):
+            if(self.error != None):
+                self.waiter.set_exception(self.error)
+            elif(self.count >= self.waiting_for):
+                self.waiter.set_result(None)
+
+    def write(self, data):
+        super().write(data)
+        self.wake_reader()
+
+    def commit(self, nbytes):
+        super().commit(nbytes)
+        self.wake_reader()
+
+    # No more data will arrive: fail the current and any future read_wait()
+    # that cannot be satisfied from the data already buffered
+    def fail(self, error):
+        self.error = error
+        self.wake_reader()
+
+    # Wait up to timeout seconds for nbytes and return them as read() would,
+    # together with any further bytes already buffered up to maxbytes.
+    # Raises asyncio.TimeoutError on timeout.
+    async def read_wait(self, nbytes, timeout, maxbytes=None):
+        if(self.count < nbytes):
+            if(self.error != None):
+                raise self.error
+            self.waiting_for = nbytes
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            finally:
+                self.waiter = None
+        return self.read(nbytes if(maxbytes==None) else min(self.count, maxbytes))
+
+    # Wait up to timeout seconds for data and return all that has arrived
+    # as bytes, or b'' if nothing did
+    async def read_available(self, timeout) -> bytes:
+        try:
+            first = bytes(await self.read_wait(1, timeout, 1))
+        except asyncio.TimeoutError:
+            return b''
+        return first + bytes(self.read(self.count))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Capture of the bytes sent and received on a debug link
+#
+# With debug_interface(..., trace=True) every put_bytes() and get_bytes()
+# on the link is recorded with a timestamp in a packet_trace: a preallocated
+# ring of fixed-size slots that keeps the most recent traffic.  Recording is
+# a struct.pack_into and a slice copy per slot, so the trace can be left on
+# in long runs.  The trace is written to a file when the link fails with a
+# checksum error or pipe error, or with dbg.dump_trace(path), and printed
+# with:
+#   fpga_debug_trace.py fpga-debug-trace-1234.bin
+
+import sys
+import argparse, struct, time
+
+TX = 0
+RX = 1
+
+trace_magic = b"FDBGTRC1"
+trace_header = struct.Struct(">8sIIQ")   # magic, slot size, slots in file, slots ever recorded
+slot_header = struct.Struct(">dBBH")     # timestamp, direction, more (data continues in next slot), length
+
+# default size of the trace
+default_slots = 16384
+slot_size = 64
+slot_payload = slot_size - slot_header.size
+
+class packet_trace:
+    # slots is rounded up to a power of 2
+    def __init__(self, slots=default_slots):
+        self.slots = 1<<max(0, (slots-1).bit_length())
+        self.buf = bytearray(self.slots*slot_size)
+        self.next = 0      # total number of slots ever written
+        self.start = time.monotonic()
+
+    def record(self, direction, data):
+        t = time.monotonic()-self.start
+        n = len(data)
+        if(n <= slot_payload):
+            pos = (self.next & (self.slots-1))*slot_size
+            slot_header.pack_into(self.buf, pos, t, direction, 0, n)
+            self.buf[pos+slot_header.size:pos+slot_header.size+n] = data
+            self.next = self.next+1
+            return
+        off = 0
+        while(True):
+            k = min(n-off, slot_payload)
+            pos = (self.next & (self.slots-1))*slot_size
+            slot_header.pack_into(self.buf, pos, t, direction, 1 if(off+k < n) else 0, k)
+            pos = pos+slot_header.size
+            self.buf[pos:pos+k] = data[off:off+k]
+            self.next = self.next+1
+            off = off+k
+            if(off >= n):
+                break
+
+    # Write the slots still held, oldest first
+    def dump(self, path):
+        held = min(self.next, self.slots)
+        first = (self.next-held) & (self.slots-1)
+        with open(path, 'wb') as f:
+            f.write(trace_header.pack(trace_magic, slot_size, held, self.next))
+            if(first+held > self.slots):
+                f.write(self.buf[first*slot_size:])
+                f.write(self.buf[0:(first+held-self.slots)*slot_size])
+            else:
+                f.write(self.buf[first*slot_size:(first+held)*slot_size])
+
+    def clear(self):
+        self.next = 0
+
+# Read a trace file, returning (number of slots ever recorded, list of
+# (timestamp, direction, bytes)) with data split across slots rejoined.  The
+# first entry may be the tail of a transfer whose start was overwritten.
+def read_trace(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    (magic, size, held, total) = trace_header.unpack_from(raw, 0)
+    if(magic != trace_magic):
+        raise TraceFileError("%s is not a packet trace file" % (path))
+    entries = []
+    data = b''
+    for j in range(held):
+        pos = trace_header.size + j*size
+        (t, direction, more, length) = slot_header.unpack_from(raw, pos)
+        data = data + raw[pos+slot_header.size:pos+slot_header.size+length]
+        if(not(more)):
+            entries.append((t, direction, data))
+            data = b''
+    if(len(data) > 0):
+        entries.append((t, direction, data))
+    return (total, entries)
+
+# Pipe wrapper recording all traffic in a packet_trace and calling on_error()
+# if the pipe raises an exception
+class traced_pipe:
+    def __init__(self, pipe, trace, on_error):
+        self.__dict__['pipe'] = pipe
+        self.__dict__['trace'] = trace
+        self.__dict__['on_error'] = on_error
+
+    # anything else (calc_checksum, clear_read_buf, close, metrics, etc.) is
+    # passed through to the pipe
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.pipe, name, value)
+
+    def put_bytes(self, bytes_list):
+        self.trace.record(TX, bytes_list)
+        try:
+            return self.pipe.put_bytes(bytes_list)
+        except Exception:
+            self.on_error()
+            raise
+
+    def get_bytes(self, nbytes, timeout=None):
+        return self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        try:
+            r = self.pipe.get_bytes_upto(minbytes, maxbytes, timeout)
+        except Exception:
+            self.on_error()
+            raise
+        self.trace.record(RX, r)
+        return r
+
+    def read_available(self, timeout):
+        r = self.pipe.read_available(timeout)
+        if(len(r) > 0):
+            self.trace.record(RX, r)
+        return r
+
+class async_traced_pipe(traced_pipe):
+    async def put_bytes(self, bytes_list):
+        self.trace.record(TX, bytes_list)
+        try:
+            return await self.pipe.put_bytes(bytes_list)
+        except Exception:
+            self.on_error()
+            raise
+
+    async def get_bytes(self, nbytes, timeout=None):
+        return await self.get_bytes_upto(nbytes, nbytes, timeout)
+
+    async def get_bytes_upto(self, minbytes, maxbytes, timeout=None):
+        try:
+            r = await self.pipe.get_bytes_upto(minbytes, maxbytes, timeout)
+        except Exception:
+            self.on_error()
+            raise
+        self.trace.record(RX, r)
+        return r
+
+    async def read_available(self, timeout):
+        r = await self.pipe.read_available(timeout)
+        if(len(r) > 0):
+            self.trace.record(RX, r)
+        return r
+
+class TraceFileError(Exception):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser(prog='fpga_debug_trace.py', description='Print a debug link packet trace')
+    parser.add_argument('trace', type=str, action='store', help='trace file written by debug_interface')
+    args = parser.parse_args()
+    (total, entries) = read_trace(args.trace)
+    print("%d entries (%d slots recorded in total)" % (len(entries), total))
+    for (t, direction, data) in entries:
+        print("%12.6f %s %s" % (t, "TX" if(direction==TX) else "RX", data.hex(' ')))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
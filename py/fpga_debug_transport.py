@@ -0,0 +1,84 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Registry of the transports that carry the debug link
+#
+# A transport is selected with a URI and its module is only imported when a
+# link is opened, so simulation runs do not load intel_jtag_uart:
+#   sim://                       named pipes in the current directory
+#   sim:///path/to/pipes         named pipes in /path/to/pipes
+#   jtag://DE10-Pro [5-2.3.1]    JTAG UART on a cable (jtag:// for the first cable)
+#   broker://                    link_broker.py serving the simulation
+#   broker:///tmp/link.sock      link_broker.py listening on a given socket
+#   loopback://                  in-process model of FPGADebugInterface
+# Options follow a '?', e.g. sim://?timeout=60 or
+# jtag://DE10-Pro [5-2.3.1]?reader_thread=1&instance=0 (see the
+# open_transport() function of each transport module).
+#
+# Other transports are added with register_transport(); the module must
+# provide open_transport(location, options, asynchronous) returning a pipe
+# interface.
+
+import importlib
+from urllib.parse import parse_qsl
+
+# scheme -> (module name, True if it is a simulation, False if it is
+# hardware, None if it depends on what is at the other end)
+transports = {}
+
+def register_transport(scheme, module, simulation=False):
+    transports[scheme] = (module, simulation)
+
+register_transport('sim', 'fpga_debug_pipe_sim', True)
+register_transport('jtag', 'fpga_debug_pipe_fpga', False)
+register_transport('fpga', 'fpga_debug_pipe_fpga', False)
+register_transport('broker', 'fpga_debug_pipe_broker', None)
+register_transport('loopback', 'fpga_debug_pipe_loopback', True)
+
+# Split a URI into (scheme, location, dictionary of options)
+def parse_uri(uri):
+    (scheme, sep, rest) = uri.partition('://')
+    if((sep == '') or (scheme not in transports)):
+        raise TransportError("unknown debug link transport %s (known: %s)"
+                             % (repr(uri), ", ".join(["%s://" % (s) for s in sorted(transports.keys())])))
+    (location, sep, query) = rest.partition('?')
+    return (scheme, location, dict(parse_qsl(query)))
+
+# Import the module for a scheme
+def transport_module(scheme):
+    return importlib.import_module(transports[scheme][0])
+
+def open_transport(uri, asynchronous=False):
+    (scheme, location, options) = parse_uri(uri)
+    return transport_module(scheme).open_transport(location, options, asynchronous)
+
+def is_simulation(uri):
+    return transports[parse_uri(uri)[0]][1]
+
+class TransportError(Exception):
+    pass
@@ -0,0 +1,156 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Record and replay binary test vectors
+#
+# A debug_interface session is recorded with:
+#   dbg.start_recording("test.vec")
+#   ... dbg.write(), dbg.read(), dbg.batch(), etc. ...
+#   dbg.stop_recording()
+# and replayed, at full link speed, with:
+#   (count, mismatches) = fpga_debug_vectors.replay(dbg, "test.vec")
+#
+# File format: a header (magic, record size, number of records) followed by
+# one 21 byte record per Cmd_write_word or Cmd_read_word command: the 11
+# byte command packet as sent on the link, then the expected response laid
+# out as an Rsp_read_data packet (code, 8 bytes of data, checksum) with zero
+# data for responses that carry none.  Other commands (e.g. the zero bytes
+# from clear()) are not recorded.
+#
+# Replay maps the file and streams it a chunk at a time: the command packets
+# of a chunk are sent as one pipelined batch and the responses compared with
+# the expected ones in bulk.  Replay needs NumPy.
+
+import mmap
+import struct
+import fpga_debug_codec
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+vector_magic = b"FDBGVEC1"
+vector_header = struct.Struct(">8sIQ")   # magic, record size, number of records
+response_slot = struct.Struct(">BQ")     # code, data (then checksum)
+record_size = fpga_debug_codec.command_packet_size + fpga_debug_codec.read_data_response_size
+
+# Number of records replayed per batch
+replay_chunk = 4096
+
+class vector_recorder:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(vector_header.pack(vector_magic, record_size, 0))
+        self.buf = bytearray()
+        self.count = 0
+
+    # Record a command packet with the response code (an int or
+    # DebugResponseCode) and data (None if there was none)
+    def add(self, packet, code, data):
+        slot = response_slot.pack(code if(isinstance(code, int)) else code.value, 0 if(data==None) else data)
+        self.buf += packet
+        self.buf += slot
+        self.buf.append((sum(slot) + fpga_debug_codec.checksum_init) & 0xff)
+        self.count = self.count+1
+        if(len(self.buf) >= 65536):
+            self.flush()
+
+    # Record a batch given its packets and list of (code, data) results
+    def add_batch(self, packets, results):
+        size = fpga_debug_codec.command_packet_size
+        for (j, (code, data)) in enumerate(results):
+            self.add(packets[j*size:(j+1)*size], code, data)
+
+    # As add_batch() but given NumPy arrays of the response codes and data
+    def add_arrays(self, packets, codes, data):
+        n = len(codes)
+        size = fpga_debug_codec.command_packet_size
+        rec = np.empty((n, record_size), dtype=np.uint8)
+        rec[:, 0:size] = np.frombuffer(packets, dtype=np.uint8, count=n*size).reshape(n, size)
+        rec[:, size] = codes
+        rec[:, size+1:record_size-1] = data.astype(">u8").view(np.uint8).reshape(n, 8)
+        rec[:, record_size-1] = (rec[:, size:record_size-1].sum(axis=1, dtype=np.uint32) + fpga_debug_codec.checksum_init) & 0xff
+        self.buf += rec.tobytes()
+        self.count = self.count+n
+        if(len(self.buf) >= 65536):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buf)
+        self.buf = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.file.write(vector_header.pack(vector_magic, record_size, self.count))
+        self.file.close()
+
+# Map a vector file, returning (mmap, number of records)
+def open_vectors(path):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, size, count) = vector_header.unpack_from(mm, 0)
+    if((magic != vector_magic) or (size != record_size)):
+        mm.close()
+        raise VectorFileError("%s is not a test vector file" % (path))
+    if(len(mm) < vector_header.size + count*record_size):
+        mm.close()
+        raise VectorFileError("%s is truncated" % (path))
+    return (mm, count)
+
+# Replay a vector file over dbg (a debug_interface).  Returns the number of
+# records replayed and a list of (record number, expected (code, data), got
+# (code, data)) for each response that did not match.
+def replay(dbg, path, chunk=replay_chunk, max_in_flight=None):
+    (mm, count) = open_vectors(path)
+    mismatches = []
+    with mm:
+        for start in range(0, count, chunk):
+            off = vector_header.size + start*record_size
+            # slicing the mapping copies the chunk out, so nothing refers
+            # to the mapping when it is closed
+            rec = np.frombuffer(mm[off:off+min(chunk, count-start)*record_size], dtype=np.uint8).reshape(-1, record_size)
+            packets = rec[:, 0:fpga_debug_codec.command_packet_size].tobytes()
+            if(max_in_flight == None):
+                (codes, data) = dbg.batch(None, packets=packets, arrays=True)
+            else:
+                (codes, data) = dbg.batch(None, max_in_flight, packets=packets, arrays=True)
+            mismatches.extend(compare(start, rec, codes, data))
+    return (count, mismatches)
+
+# Compare a chunk of records with the response codes and data of its batch
+def compare(start, rec, codes, data):
+    n = len(codes)
+    expected_codes = rec[:, fpga_debug_codec.command_packet_size]
+    expected_data = rec[:, fpga_debug_codec.command_packet_size+1:record_size-1].copy().view(">u8").reshape(n)
+    bad = np.nonzero((codes != expected_codes) | (data != expected_data))[0]
+    return [(start+int(j), (int(expected_codes[j]), int(expected_data[j])), (int(codes[j]), int(data[j])))
+            for j in bad]
+
+class VectorFileError(Exception):
+    pass
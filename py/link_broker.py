@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Daemon that owns the link to one FPGA (or simulation) and shares it
+#
+# Opening intel_jtag_uart takes seconds and only one process can hold a
+# cable, so the broker opens the link once and serves any number of clients
+# over a Unix-domain socket.  Command packets from all clients are merged
+# into batches on the link, keeping up to batch_max_in_flight outstanding,
+# and each response is routed back to the client that sent the command.
+# Clients use debug_interface(..., broker=True), e.g.:
+#   link_broker.py --cable "DE10-Pro [5-2.3.1]" &
+#   dbg = fpga_debug_interface.debug_interface(sim=False, cable_name="DE10-Pro [5-2.3.1]", broker=True)
+# For local testing the broker can sit in front of a simulation with --sim.
+#
+# Client packets are checked before they reach the link: packets with a bad
+# checksum are answered by the broker with Rsp_checksum_fail, zero bytes
+# between packets (as sent by debug_interface.clear()) are dropped, and
+# Cmd_end_sim is ignored since the link is shared.  A write burst is
+# forwarded whole, header, payload and checksum, as the hardware takes it:
+# only a header with a good checksum and a valid length has a payload.
+# Read burst data is routed like read data, its length taken from the
+# burst at the head of the queue of reads.  The broker probes the link for
+# bursts when it starts (see fpga_debug_interface.burst_probe) and answers
+# bursts with an invalid length itself, with Rsp_invalid as the hardware
+# would, or, if the link has no bursts, every burst: a client's probe is
+# then left unanswered as it would be by the hardware, and any other burst
+# is answered with Rsp_invalid.
+#
+# Only acks are routed to writers.  FPGADebugInterface sends any other short
+# response (Rsp_checksum_fail, Rsp_invalid) through the same queue as the
+# acks whether it answers a read or a write, so it cannot be matched to a
+# client: every outstanding command is then failed with it and the link
+# resynchronised (see fpga_debug_interface.link_resync) before any more
+# commands are sent.
+
+import sys, os
+import argparse, asyncio, signal
+from collections import deque
+import fpga_debug_codec
+import fpga_debug_pipe_broker
+import fpga_debug_transport
+from fpga_debug_interface import DebugCommand, DebugResponseCode, DebugInterfaceTimeoutError, batch_max_in_flight
+from fpga_debug_interface import link_resync, resync_flush, resync_marker, resync_markers, burst_probe, burst_probe_packet
+
+class link_broker:
+    def __init__(self, pipe, max_in_flight = batch_max_in_flight):
+        self.pipe = pipe
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.pending_reads = deque()   # (client, response size) in order
+        self.pending_writes = deque()
+        self.pending_read_bytes = 0
+        self.outstanding = asyncio.Event()
+        self.partial = b''
+        # bumped whenever outstanding commands are failed, so that the
+        # writer drops any of them it has not yet sent
+        self.generation = 0
+        self.link_lock = asyncio.Lock()
+        self.bursts = False
+        self.clients = 0
+        self.commands = 0
+
+    async def serve(self, path):
+        if(os.path.exists(path)):
+            os.unlink(path)
+        self.bursts = await self.run_link_op(burst_probe())
+        if(not(self.bursts)):
+            print("The FPGADebugInterface build does not handle bursts")
+            await self.resync_link()
+        server = await asyncio.start_unix_server(self.handle_client, path=path)
+        print("Broker listening on %s" % (path))
+        try:
+            async with server:
+                await asyncio.gather(self.link_writer(), self.link_reader())
+        finally:
+            if(os.path.exists(path)):
+                os.unlink(path)
+
+    async def handle_client(self, reader, writer):
+        self.clients = self.clients+1
+        buf = bytearray()
+        size = fpga_debug_codec.command_packet_size
+        try:
+            while(True):
+                data = await reader.read(65536)
+                if(len(data) == 0):
+                    break
+                buf += data
+                off = 0
+                while(True):
+                    while((off < len(buf)) and (buf[off] == DebugCommand.Cmd_nop.value)):
+                        off = off+1
+                    if(len(buf)-off < size):
+                        break
+                    end = off+self.packet_size(buf, off)
+                    if(len(buf) < end):
+                        break  # wait for the rest of the write burst
+                    self.queue_packet(writer, bytes(buf[off:end]))
+                    off = end
+                del buf[0:off]
+        except asyncio.CancelledError:
+            pass  # broker shutting down
+        finally:
+            self.clients = self.clients-1
+            writer.close()
+
+    # Length of the command packet at buf[off:], including the payload and
+    # payload checksum of a write burst
+    @staticmethod
+    def packet_size(buf, off):
+        size = fpga_debug_codec.command_packet_size
+        if(buf[off] != fpga_debug_codec.CMD_WRITE_BURST):
+            return size
+        (cmd, index, n, checksum) = fpga_debug_codec.command_packet.unpack_from(buf, off)
+        if((fpga_debug_codec.calc_checksum(buf[off:off+size-1]) != checksum)
+           or (n < 1) or (n > fpga_debug_codec.burst_max_words)):
+            return size
+        return size+n*8+1
+
+    # Size of the response to a command
+    @staticmethod
+    def response_size(packet):
+        if(packet[0] == fpga_debug_codec.CMD_READ_BURST):
+            return fpga_debug_codec.command_packet.unpack_from(packet, 0)[2]*8+2
+        if(packet[0] == DebugCommand.Cmd_read_word.value):
+            return fpga_debug_codec.read_data_response_size
+        return fpga_debug_codec.short_response_size
+
+    @staticmethod
+    def short_response(code):
+        return bytes((code.value, fpga_debug_codec.calc_checksum([code.value])))
+
+    def queue_packet(self, client, packet):
+        size = fpga_debug_codec.command_packet_size
+        if(fpga_debug_codec.calc_checksum(packet[0:size-1]) != packet[size-1]):
+            client.write(self.short_response(DebugResponseCode.Rsp_checksum_fail))
+        elif(packet[0] in (fpga_debug_codec.CMD_WRITE_BURST, fpga_debug_codec.CMD_READ_BURST)
+             and not(self.bursts and (1 <= fpga_debug_codec.command_packet.unpack_from(packet, 0)[2] <= fpga_debug_codec.burst_max_words))):
+            if(self.bursts or (packet[0:size-1] != burst_probe_packet[0:size-1])):
+                client.write(self.short_response(DebugResponseCode.Rsp_invalid))
+        elif(packet[0] != DebugCommand.Cmd_end_sim.value):
+            self.queue.put_nowait((client, packet))
+
+    # Forward queued packets from all clients to the link, as many at a time
+    # as the in-flight window allows
+    async def link_writer(self):
+        while(True):
+            items = [await self.queue.get()]
+            while(not(self.queue.empty())):
+                items.append(self.queue.get_nowait())
+            tx = bytearray()
+            generation = self.generation
+            for (client, packet) in items:
+                cmd = packet[0]
+                if(cmd in (DebugCommand.Cmd_read_word.value, DebugCommand.Cmd_write_word.value,
+                           DebugCommand.Cmd_read_burst.value, DebugCommand.Cmd_write_burst.value)):
+                    if(self.slots.locked() and (len(tx) > 0)):
+                        await self.send(tx, generation)
+                        tx = bytearray()
+                    await self.slots.acquire()
+                    if(self.generation != generation):
+                        tx = bytearray()  # already failed
+                        generation = self.generation
+                    if(cmd in (DebugCommand.Cmd_read_word.value, DebugCommand.Cmd_read_burst.value)):
+                        size = self.response_size(packet)
+                        self.pending_reads.append((client, size))
+                        self.pending_read_bytes = self.pending_read_bytes+size
+                    else:
+                        self.pending_writes.append(client)
+                    self.outstanding.set()
+                tx += packet
+                self.commands = self.commands+1
+            await self.send(tx, generation)
+
+    async def send(self, tx, generation):
+        async with self.link_lock:
+            if((len(tx) > 0) and (generation == self.generation)):
+                await self.pipe.put_bytes(tx)
+
+    # Route responses from the link back to the clients.  Responses are
+    # matched per stream as in fpga_debug_interface.command_batch.
+    async def link_reader(self):
+        while(True):
+            await self.outstanding.wait()
+            maxbytes = (self.pending_read_bytes
+                        + fpga_debug_codec.short_response_size*len(self.pending_writes) - len(self.partial))
+            minbytes = fpga_debug_codec.short_response_size
+            if(len(self.partial) > 0):
+                minbytes = self.link_response_size(self.partial[0]) - len(self.partial)
+            try:
+                chunk = await self.pipe.get_bytes_upto(minbytes, max(minbytes, maxbytes))
+            except Exception as e:
+                print("ERROR: link timed out with %d commands outstanding, dropping them: %s"
+                      % (len(self.pending_reads)+len(self.pending_writes), repr(e)))
+                self.drop_outstanding()
+                continue
+            buf = self.partial + bytes(chunk)
+            off = 0
+            while(off < len(buf)):
+                end = off+self.link_response_size(buf[off])
+                if(end > len(buf)):
+                    break
+                if(not(self.route_response(buf[off:end]))):
+                    await self.resync(buf[off:end])
+                    (buf, off) = (b'', 0)
+                    break
+                off = end
+            self.partial = buf[off:]
+
+    # Length of the response from the link starting with code
+    def link_response_size(self, code):
+        if((code == fpga_debug_codec.RSP_READ_BURST_DATA) and self.pending_reads):
+            return self.pending_reads[0][1]
+        return fpga_debug_codec.response_size(code)
+
+    # Send a response to its client.  Returns False for a response that
+    # cannot be matched to a client.
+    def route_response(self, response):
+        code = response[0]
+        if(code in (fpga_debug_codec.RSP_READ_DATA, fpga_debug_codec.RSP_READ_BURST_DATA)):
+            pending = self.pending_reads
+        elif(code in (DebugResponseCode.Rsp_write_ack.value, DebugResponseCode.Rsp_write_burst_ack.value)):
+            pending = self.pending_writes
+        else:
+            return False
+        if(not(pending)):
+            print("ERROR: broker received unexpected response: 0x%02x" % (code))
+            return True
+        if(pending is self.pending_reads):
+            (client, size) = pending.popleft()
+            self.pending_read_bytes = self.pending_read_bytes-size
+        else:
+            client = pending.popleft()
+        self.slots.release()
+        if(not(self.pending_reads or self.pending_writes)):
+            self.outstanding.clear()
+        if(not(client.is_closing())):
+            client.write(response)
+        return True
+
+    # Forget the outstanding commands, answering each with response if given
+    def drop_outstanding(self, response=None):
+        if(response != None):
+            for client in [c for (c, size) in self.pending_reads] + list(self.pending_writes):
+                if(not(client.is_closing())):
+                    client.write(response)
+        for j in range(len(self.pending_reads)+len(self.pending_writes)):
+            self.slots.release()
+        self.pending_reads.clear()
+        self.pending_writes.clear()
+        self.pending_read_bytes = 0
+        self.partial = b''
+        self.outstanding.clear()
+        self.generation = self.generation+1
+
+    # Fail every outstanding command with an unmatched response and drain
+    # the link of the responses to any that were still in flight.  Commands
+    # the writer sent while waiting for the link are failed too.
+    async def resync(self, response):
+        print("ERROR: link answered 0x%02x with %d commands outstanding, failing them and resynchronising"
+              % (response[0], len(self.pending_reads)+len(self.pending_writes)))
+        self.drop_outstanding(response)
+        async with self.link_lock:
+            self.drop_outstanding(response)
+            await self.resync_link()
+
+    async def resync_link(self):
+        r = link_resync()
+        await self.pipe.put_bytes(resync_flush + resync_marker*resync_markers)
+        try:
+            while(not(r.done())):
+                r.put_bytes(await self.pipe.read_available(r.wait_time()))
+        except DebugInterfaceTimeoutError as e:
+            print("ERROR: %s" % (e))
+
+    # Run a link operation of fpga_debug_interface (see
+    # fpga_debug_interface.debug_interface.run) directly on the link
+    async def run_link_op(self, op):
+        result = None
+        while(True):
+            try:
+                request = op.send(result)
+            except StopIteration as e:
+                return e.value
+            result = await getattr(self.pipe, request[0])(*request[1:])
+
+def open_link(args):
+    return fpga_debug_transport.open_transport("sim://" if(args.sim) else "jtag://"+args.cable, asynchronous=True)
+
+async def run_broker(args):
+    path = args.socket if(args.socket!=None) else fpga_debug_pipe_broker.socket_path(None if(args.sim) else args.cable)
+    broker = link_broker(open_link(args))
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await broker.serve(path)
+    except asyncio.CancelledError:
+        print("Broker exiting after %d commands" % (broker.commands))
+
+def main():
+    parser = argparse.ArgumentParser(prog='link_broker.py',
+                                     description='Share the debug link to an FPGA or simulation between processes')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sim', action='store_true', default=False,
+                       help='serve the simulation named pipes in the current directory')
+    group.add_argument('-c', '--cable', type=str, action='store', default=None,
+                       help='FPGA cable name (from jtagconfig, e.g. "DE10-Pro [5-2.3.1]")')
+    parser.add_argument('-s', '--socket', type=str, action='store', default=None,
+                        help='Unix-domain socket to listen on (default: derived from the cable name)')
+    args = parser.parse_args()
+    if(not(args.sim) and (args.cable==None)):
+        parser.error('Select --sim or --cable')
+    asyncio.run(run_broker(args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Run a test concurrently on every DE10-Pro board
+#
+# The test is given as path/to/script.py:class, where the class follows the
+# pattern of the tests in tests/, e.g. simple_test in
+# tests/fpgadebuginterface/tstdebug.py:
+#  - the constructor takes (simulation_mode, cable_name) and opens its own
+#    debug_interface as self.dbg
+#  - a method (default run_test) runs one iteration of the test
+#  - self.error is set if the test failed
+# Each board is tested in its own process since only one process can hold
+# a JTAG cable.  Example:
+#   parallel_test_runner.py ../tests/fpgadebuginterface/tstdebug.py:simple_test --n 10
+#
+# With --shards K the iterations are instead spread over K simulators run
+# at once, each in its own temporary directory with its own named pipes,
+# e.g. after building the iverilog simulation with make in the test
+# directory:
+#   parallel_test_runner.py ../tests/fpgadebuginterface/tstdebug.py:simple_test --n 64 --shards 8
+
+import sys, os, time, io
+import argparse, contextlib, importlib.util, traceback, tempfile
+import subprocess as sp
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import fpga_debug_pipe_sim
+
+# time to wait for a simulator to exit once its test has finished
+sim_exit_timeout = 10.0
+
+def load_test_class(entry):
+    (path, _, class_name) = entry.rpartition(':')
+    path = os.path.abspath(path)
+    sys.path.append(os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+# Run the test on one target in a worker process.  Returns a dict of results
+# including the captured console output.
+def run_on_target(entry, method, iterations, target_kwargs):
+    result = {'passed': False, 'iterations': 0, 'seconds': 0.0, 'commands': 0, 'error': None}
+    output = io.StringIO()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        try:
+            test_class = load_test_class(entry)
+            test = test_class(**target_kwargs)
+            start = time.monotonic()
+            for j in range(iterations):
+                getattr(test, method)()
+                result['iterations'] = j+1
+                if(test.error):
+                    break
+            result['passed'] = not(test.error)
+            result['commands'] = test.dbg.commands_sent
+        except Exception:
+            result['error'] = traceback.format_exc()
+    result['seconds'] = time.monotonic()-start
+    result['output'] = output.getvalue()
+    return result
+
+# Run the test on each target concurrently.  targets maps a name for each
+# target to the keyword arguments for the test constructor.
+def run_parallel(entry, targets, method='run_test', iterations=1, workers=None):
+    names = list(targets.keys())
+    with ProcessPoolExecutor(max_workers=workers if(workers!=None) else max(1, len(names))) as pool:
+        futures = [pool.submit(run_on_target, entry, method, iterations, targets[n]) for n in names]
+        return dict(zip(names, [f.result() for f in futures]))
+
+# The iverilog simulation built by the Makefile in the test's directory
+def default_simulator(entry):
+    return os.path.join(os.path.dirname(os.path.abspath(entry.rpartition(':')[0])), 'output_files', 'sim_top')
+
+# Run iterations of the test in a worker process against a simulator run in
+# workdir.  The simulator is started afresh for each iteration since tests
+# end the simulation when they finish.
+def run_sim_shard(entry, method, iterations, simulator, workdir):
+    fpga_debug_pipe_sim.make_pipes(workdir)
+    os.environ[fpga_debug_pipe_sim.PIPE_DIR_ENV] = workdir
+    log_path = os.path.join(workdir, 'sim.log')
+    result = {'passed': True, 'iterations': 0, 'seconds': 0.0, 'commands': 0, 'error': None, 'output': ''}
+    start = time.monotonic()
+    for j in range(iterations):
+        with open(log_path, 'ab') as log:
+            sim = sp.Popen([simulator], cwd=workdir, stdout=log, stderr=sp.STDOUT)
+        r = run_on_target(entry, method, 1, {'simulation_mode': True, 'cable_name': None})
+        try:
+            sim.wait(timeout=sim_exit_timeout)
+        except sp.TimeoutExpired:
+            sim.kill()
+            sim.wait()
+        result['iterations'] = result['iterations']+r['iterations']
+        result['commands'] = result['commands']+r['commands']
+        result['output'] = result['output']+r['output']
+        if(not(r['passed'])):
+            result['passed'] = False
+            result['error'] = r['error']
+            with open(log_path, 'r', errors='replace') as log:
+                result['output'] = result['output']+"simulator output:\n"+log.read()
+            break
+    result['seconds'] = time.monotonic()-start
+    return result
+
+# Spread iterations of the test over shards simulators run concurrently and
+# return the results for each shard
+def run_sharded(entry, shards, iterations, method='run_test', simulator=None, workers=None):
+    simulator = os.path.abspath(default_simulator(entry) if(simulator==None) else simulator)
+    counts = [iterations//shards + (1 if(k < iterations%shards) else 0) for k in range(shards)]
+    counts = [n for n in counts if(n > 0)]
+    with tempfile.TemporaryDirectory(prefix='fpga-debug-shards-') as root:
+        with ProcessPoolExecutor(max_workers=workers if(workers!=None) else max(1, len(counts))) as pool:
+            futures = []
+            for k in range(len(counts)):
+                workdir = os.path.join(root, "shard%d" % (k))
+                os.mkdir(workdir)
+                futures.append(pool.submit(run_sim_shard, entry, method, counts[k], simulator, workdir))
+            return dict([("sim shard %d" % (k), futures[k].result()) for k in range(len(counts))])
+
+def report(results, verbose):
+    for name in results.keys():
+        r = results[name]
+        if(verbose or not(r['passed'])):
+            for line in r['output'].split('\n'):
+                if(line != ''):
+                    print("%s: %s" % (name, line))
+            if(r['error'] != None):
+                print("%s: %s" % (name, r['error']))
+    print("%-28s %-6s %10s %10s %12s %12s" % ("target", "result", "iterations", "time (s)", "commands", "commands/s"))
+    for name in results.keys():
+        r = results[name]
+        rate = r['commands']/r['seconds'] if(r['seconds']>0) else 0.0
+        print("%-28s %-6s %10d %10.3f %12d %12.1f"
+              % (name, "PASS" if(r['passed']) else "FAIL", r['iterations'], r['seconds'], r['commands'], rate))
+    failed = [name for name in results.keys() if not(results[name]['passed'])]
+    print("%d of %d passed" % (len(results)-len(failed), len(results)))
+    return len(failed)
+
+def main():
+    parser = argparse.ArgumentParser(prog='parallel_test_runner.py',
+                                     description='Run a test on all DE10Pro FPGA boards concurrently')
+    parser.add_argument('test', type=str, action='store',
+                        help='test class to run, e.g. ../tests/fpgadebuginterface/tstdebug.py:simple_test')
+    parser.add_argument('-m', '--method', type=str, action='store', default='run_test',
+                        help='test method to run for each iteration (default: run_test)')
+    parser.add_argument('--n', type=int, action='store', default=1,
+                        help='number of iterations on each board')
+    parser.add_argument('-c', '--cable', type=str, action='append', default=None,
+                        help='only test this cable (may be repeated, default: all DE10Pro boards)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='show test output from every board, not just failing ones')
+    parser.add_argument('--rescan', action='store_true', default=False,
+                        help='run jtagconfig even if the cached list of boards is recent')
+    parser.add_argument('-s', '--shards', type=int, action='store', default=0,
+                        help='run the --n iterations in simulation spread over this many simulators instead of on FPGAs')
+    parser.add_argument('--simulator', type=str, action='store', default=None,
+                        help='simulator for --shards (default: output_files/sim_top in the test directory)')
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=None,
+                        help='maximum number of simulators to run at once (default: one per shard)')
+    args = parser.parse_args()
+    if(args.shards > 0):
+        start = time.monotonic()
+        results = run_sharded(args.test, args.shards, args.n, method=args.method, simulator=args.simulator, workers=args.jobs)
+        failures = report(results, args.verbose)
+        print("%d iterations on %d simulators in %.1fs"
+              % (sum([r['iterations'] for r in results.values()]), len(results), time.monotonic()-start))
+        return 1 if(failures > 0) else 0
+    # only the FPGA path needs the Quartus tools that progallde10pro uses
+    import progallde10pro
+    cables = args.cable if(args.cable!=None) else list(progallde10pro.find_de10pro_devices(rescan=args.rescan).keys())
+    if(len(cables)==0):
+        print("No DE10Pro FPGA boards found")
+        return 1
+    targets = {}
+    for c in cables:
+        targets[c] = {'simulation_mode': False, 'cable_name': c}
+    results = run_parallel(args.test, targets, method=args.method, iterations=args.n)
+    return 1 if(report(results, args.verbose) > 0) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,80 +30,272 @@
 
 import subprocess as sp
 import sys, os, time
-import re, argparse
+import re, argparse, asyncio
+import hashlib, json
+import sof_cache
 
 default_num_fpgas = 8
 quartus_pgm_timeout = 60
+default_retries = 3
+default_backoff = 2.0
+# record of which SOF each board was last programmed with
+default_state_file = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                  'fpga-debug', 'programmed.json')
 
-def find_de10pro_devices():
+#----------------------------------------------------------------------------
+# Discovery of DE10Pro boards.  Running jtagconfig takes a while, so the
+# parsed result is cached in a small file shared by all the tools and reused
+# for discovery_ttl seconds unless a rescan is requested.
+
+discovery_ttl = 60.0
+discovery_cache_file = os.path.join(os.path.dirname(default_state_file), 'jtagconfig.json')
+
+device_line = re.compile(r"^(\d+)[\)]\WDE10-Pro(.*)")
+chain_line = re.compile(r"^\W+(\S+)\W+([\w\(\)\/\.\|]+)")
+fpga_part = re.compile("1SX280HH1")
+
+# A USB-to-JTAG cable and the devices on its JTAG chain as (id code, name)
+class cable:
+    def __init__(self, name, chain):
+        self.name = name
+        self.chain = [tuple(link) for link in chain]
+        self.fpga_index = fpga_chain_index(self.chain)
+
+    def __repr__(self):
+        return "cable(%r, %r)" % (self.name, self.chain)
+
+# Index (from 1) in the JTAG chain of the Stratix 10 FPGA to program
+def fpga_chain_index(chain):
+    id = 0
+    j=0
+    for link in chain:
+        j=j+1
+        if(fpga_part.match(link[1])):
+            id=j
+    return id
+
+def parse_jtagconfig(output):
     devices = {}
     dev = None
     jtagchain = []
-    try:
-        proc = sp.run(["jtagconfig"], stdout=sp.PIPE, stderr=sys.stderr, timeout=5, check=True)
-    except:
-        return {}
-    proc_stdout = proc.stdout.decode()
-    for line in proc_stdout.split('\n'):
+    for line in output.split('\n'):
         if(dev==None):
-            d = re.match("^(\d+)[\)]\WDE10-Pro(.*)", line)
+            d = device_line.match(line)
             if(d != None):
                 dev = "DE10-Pro"+d.group(2)
         else:
-            jtag = re.match("^\W+(\S+)\W+([\w\(\)\/\.\|]+)", line)
+            jtag = chain_line.match(line)
             if(jtag==None):  # end of jtag chain
-                devices[dev] = jtagchain
+                devices[dev] = cable(dev, jtagchain)
                 dev = None
                 jtagchain = []
             else:
                 jtagchain.append(jtag.groups())
+    if(dev != None):
+        devices[dev] = cable(dev, jtagchain)
+    return devices
+
+def load_discovery_cache(ttl):
+    try:
+        with open(discovery_cache_file, 'r') as f:
+            cached = json.load(f)
+        if(time.time()-cached['time'] < ttl):
+            return dict([(name, cable(name, chain)) for (name, chain) in cached['devices'].items()])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_discovery_cache(devices):
+    try:
+        os.makedirs(os.path.dirname(discovery_cache_file), exist_ok=True)
+        tmp = "%s.%d" % (discovery_cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'time': time.time(), 'devices': dict([(d, devices[d].chain) for d in devices.keys()])}, f)
+        os.replace(tmp, discovery_cache_file)
+    except OSError:
+        pass
+
+# Returns a dictionary mapping cable names to cable objects, from the cache
+# if it is less than ttl seconds old and rescan is False
+def find_de10pro_devices(rescan=False, ttl=None):
+    if(not(rescan)):
+        devices = load_discovery_cache(discovery_ttl if(ttl==None) else ttl)
+        if(devices != None):
+            return devices
+    try:
+        proc = sp.run(["jtagconfig"], stdout=sp.PIPE, stderr=sys.stderr, timeout=5, check=True)
+    except:
+        return {}
+    devices = parse_jtagconfig(proc.stdout.decode())
+    if(len(devices) > 0):
+        save_discovery_cache(devices)
     return devices
 
-def spawn_quartus_pgm(devices,sof,sequential):
-    process_list = []
+async def spawn_quartus_pgm(c, sof):
     no_license_env = os.environ.copy()
     no_license_env['LM_LICENSE_FILE']=''
-    for d in devices.keys():
-        print("usb-to-jtag=", d, " jtag =", devices[d])
-        id = 0
-        j=0
-        for chain in devices[d]:
-            j=j+1
-            if(re.match("1SX280HH1",chain[1])):
-                id=j
-        cmd = ['quartus_pgm', '-m', 'jtag', '-c', d, '-o', 'p;%s@%d'%(sof,id)]
-        print(' '.join(cmd))
-        p=sp.Popen(cmd, stdout=sp.PIPE, stderr=sys.stderr, env=no_license_env)
-        process_list.append(p)
-        if(sequential):
-            p.wait(timeout=quartus_pgm_timeout)
-    return process_list
-
-def report_process_status(devices, process_list, verbose):
-    error_report = {}
-    for d in devices.keys():
-        error = False
-        proc = process_list.pop(0)
+    cmd = ['quartus_pgm', '-m', 'jtag', '-c', c.name, '-o', 'p;%s@%d'%(sof,c.fpga_index)]
+    print("usb-to-jtag=", c.name, " jtag =", c.chain)
+    print(' '.join(cmd))
+    return await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=sys.stderr, env=no_license_env)
+
+# Print the output of quartus_pgm as it arrives and return True if it
+# reported an error
+async def stream_process_status(d, proc, verbose):
+    error = False
+    async for line in proc.stdout:
+        line = line.decode().rstrip('\n')
+        error_found = ("Error" in line)
+        error = error or error_found
+        if(verbose or error_found
+           or ("Info: Quartus Prime Programmer was" in line)
+           or ("Info: Elapsed time" in line)):
+            print(d+": "+line, flush=True)
+    return (await proc.wait() != 0) or error
+
+# Program one board, returning True on success
+async def program_device(d, c, sof, slots, verbose):
+    async with slots:
+        proc = await spawn_quartus_pgm(c, sof)
         try:
-            proc.wait(timeout=quartus_pgm_timeout)
-        except:
+            return not(await asyncio.wait_for(stream_process_status(d, proc, verbose), quartus_pgm_timeout))
+        except asyncio.TimeoutError:
             print("%s: ERROR: Process programming timed out"%(d))
-            error = True
             proc.kill()
-        else:
-            report=[]
-            so = proc.communicate()[0].decode()
-            for line in so.split('\n'):
-                error_found = ("Error" in line)
-                error = error or error_found
-                if(verbose or error_found
-                   or ("Info: Quartus Prime Programmer was" in line)
-                   or ("Info: Elapsed time" in line)):
-                    report.append(d+": "+line)
-            print('\n'.join(report))
-        finally:
-            error_report[d] = error
-    return error_report
+            await proc.wait()
+            return False
+
+# Program one board, retrying with exponential backoff if it fails.  Other
+# boards carry on meanwhile.
+async def program_with_retries(d, c, sof, slots, verbose, attempts, backoff):
+    for attempt in range(attempts):
+        if(await program_device(d, c, sof, slots, verbose)):
+            return True
+        if(attempt+1 < attempts):
+            delay = backoff * (2**attempt)
+            print("PROGRAMMING ERROR: FPGA %s failed to program, will retry in %gs"%(d, delay))
+            await asyncio.sleep(delay)
+    print("PROGRAMMING ERROR: FPGA %s failed to program after %d attempts"%(d, attempts))
+    return False
+
+# Program all devices, at most jobs at a time (0 = all at once).  Returns a
+# dictionary of True/False for success for each device.
+async def program_all(devices, sof, jobs, verbose, attempts, backoff):
+    slots = asyncio.Semaphore(jobs if(jobs>0) else max(1, len(devices)))
+    names = list(devices.keys())
+    results = await asyncio.gather(*[program_with_retries(d, devices[d], sof, slots, verbose, attempts, backoff)
+                                     for d in names])
+    return dict(zip(names, results))
+
+def program_devices(devices, sof, jobs=0, verbose=False, retries=default_retries, backoff=default_backoff):
+    return asyncio.run(program_all(devices, sof, jobs, verbose, retries+1, backoff))
+
+#----------------------------------------------------------------------------
+# Programming cache: the state file maps each cable name to the SHA-256 of
+# the SOF last programmed through it and, if an identity index is given, a
+# word read back from the design through the debug interface just after
+# programming.  A board is only skipped if the SOF is the same and the
+# identity word still reads back the same, which catches boards that were
+# power cycled or programmed by someone else; the state file alone is never
+# trusted, so with no identity index (the default) every board is
+# programmed.
+#
+# The identity index must be a build ID register of the design that reads
+# without side effects: a general register may have been written since, a
+# FIFO read (e.g. index 0 of tstDualPortRAM) changes the design, and the
+# chip ID (index 0 of tests/example_chip_id) belongs to the silicon, so it
+# reads back the same whatever design is loaded.  The readbacks run
+# alongside the programming of other boards.
+
+default_identity_index = None
+
+def sof_digest(sof):
+    h = hashlib.sha256()
+    with open(sof, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Path of the SOF to program given a SOF, a bzip2 compressed SOF (e.g.
+# tests/example_chip_id/prebuilt_image.sof.bz2) or, if cached, a test
+# directory whose image is taken from the SOF cache (see sof_cache.py)
+def resolve_sof(sof, cached=False, cache_dir=sof_cache.default_cache_dir):
+    store = sof_cache.image_store(cache_dir)
+    if(cached):
+        key = sof_cache.fingerprint(sof)
+        path = store.fetch(key)
+        if(path == None):
+            raise FileNotFoundError("no image for %s in the SOF cache (%s)" % (sof, key))
+        return path
+    if(sof.endswith('.bz2')):
+        return store.unpack_file(sof)
+    return sof
+
+def load_state(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# Read a word from the design on cable d, or None if the design does not
+# respond
+def read_identity(d, index):
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import fpga_debug_interface
+    try:
+        dbg = fpga_debug_interface.debug_interface(sim=False, cable_name=d)
+        return dbg.read(index)
+    except Exception as e:
+        print("%s: identity readback failed: %s"%(d, repr(e)))
+        return None
+
+# Check one board against its state file entry and program it unless it
+# is still running the SOF.  Returns (success, new state entry), the entry
+# being None if the board was skipped or failed.
+async def program_if_stale(d, c, sof, digest, entry, identity_index, force, slots, verbose, attempts, backoff):
+    loop = asyncio.get_running_loop()
+    if(not(force) and (identity_index != None) and (entry != None) and (entry.get('sha256') == digest)):
+        identity = await loop.run_in_executor(None, read_identity, d, identity_index)
+        if((identity != None) and (identity == entry.get('identity'))):
+            print("%s: already programmed with %s, skipping"%(d, entry.get('sof')))
+            return (True, None)
+        print("%s: design identity does not match, reprogramming"%(d))
+    if(not(await program_with_retries(d, c, sof, slots, verbose, attempts, backoff))):
+        return (False, None)
+    identity = None if(identity_index==None) else await loop.run_in_executor(None, read_identity, d, identity_index)
+    return (True, {'sha256': digest, 'sof': os.path.abspath(sof), 'time': time.time(), 'identity': identity})
+
+async def program_stale_all(devices, sof, digest, state, identity_index, force, jobs, verbose, attempts, backoff):
+    slots = asyncio.Semaphore(jobs if(jobs>0) else max(1, len(devices)))
+    names = list(devices.keys())
+    results = await asyncio.gather(*[program_if_stale(d, devices[d], sof, digest, state.get(d), identity_index, force,
+                                                      slots, verbose, attempts, backoff)
+                                     for d in names])
+    return dict(zip(names, results))
+
+# Program only the devices not already running sof.  Returns a dictionary
+# of True/False for success for every device, skipped ones included.
+def program_stale_devices(devices, sof, state_file=default_state_file, identity_index=default_identity_index, force=False,
+                          jobs=0, verbose=False, retries=default_retries, backoff=default_backoff):
+    digest = sof_digest(sof)
+    outcomes = asyncio.run(program_stale_all(devices, sof, digest, load_state(state_file), identity_index, force,
+                                             jobs, verbose, retries+1, backoff))
+    state = load_state(state_file)  # may have been updated by another process meanwhile
+    for (d, (ok, entry)) in outcomes.items():
+        if(entry != None):
+            state[d] = entry
+        elif(not(ok)):
+            state.pop(d, None)
+    save_state(state_file, state)
+    return dict([(d, ok) for (d, (ok, entry)) in outcomes.items()])
 
 def main():
     global quartus_pgm_timeout
@@ -112,45 +304,60 @@ def main():
     parser.add_argument('-n', '--numfpga', type=int, action='store', default=default_num_fpgas,
                         help='number of FPGAs in the system (default: %d)'%(default_num_fpgas))
     parser.add_argument('sof', type=str, action='store',
-                        help='SOF file to program the FPGA')
+                        help='SOF file to program the FPGA, optionally bzip2 compressed, or with --cached a test directory')
     parser.add_argument('-s', '--sequential', action='store_true', default=False,
-                        help='program FPGAs sequentially')
+                        help='program FPGAs sequentially (same as --jobs 1)')
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=0,
+                        help='maximum number of FPGAs to program at once (default: all)')
+    parser.add_argument('-r', '--retries', type=int, action='store', default=default_retries,
+                        help='number of times to retry a failed FPGA (default: %d)'%(default_retries))
+    parser.add_argument('-b', '--backoff', type=float, action='store', default=default_backoff,
+                        help='delay before the first retry of an FPGA in seconds, doubled for each further retry (default: %gs)'%(default_backoff))
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
-                        help='program FPGAs sequentially')
+                        help='show all output from quartus_pgm')
     parser.add_argument('-t', '--timeout', type=int, action='store', default=quartus_pgm_timeout,
                         help='quartus_pgm timeout in seconds (default=%ds)'%(quartus_pgm_timeout))
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='program every FPGA even if it is recorded as already running this SOF')
+    parser.add_argument('-i', '--identity-index', type=int, action='store', default=default_identity_index,
+                        help='index of a side-effect-free build ID register read back to check a board still runs the recorded design before skipping it (default: none, program every board)')
+    parser.add_argument('--state-file', type=str, action='store', default=default_state_file,
+                        help='programming state file (default: %s)'%(default_state_file))
+    parser.add_argument('--rescan', action='store_true', default=False,
+                        help='run jtagconfig even if the cached list of boards is recent')
+    parser.add_argument('--cached', action='store_true', default=False,
+                        help='program the image for the test directory given as the SOF from the SOF cache')
+    parser.add_argument('--cache-dir', type=str, action='store', default=sof_cache.default_cache_dir,
+                        help='SOF cache directory (default: %s)'%(sof_cache.default_cache_dir))
     args = parser.parse_args()
     quartus_pgm_timeout = args.timeout
     if(not(os.path.exists(args.sof))):
         print("SOF file %s does not exist"%(args.sof))
         return(1)
+    try:
+        sof = resolve_sof(args.sof, args.cached, args.cache_dir)
+    except (OSError, EOFError) as e:
+        print("Cannot use image %s: %s"%(args.sof, e))
+        return(1)
 
     devices = []
     timeout = 4
+    rescan = args.rescan
     while((len(devices)!=args.numfpga) and (timeout>0)):
-        devices = find_de10pro_devices()
+        devices = find_de10pro_devices(rescan=rescan)
+        rescan = True  # the cache is no use if the first look failed
         if(len(devices)!=args.numfpga):
             timeout = timeout-1
             time.sleep(2)
     if(timeout==0):
         print("Found %d FPGAs but you asked to program %d. Exiting."%(len(devices),args.numfpga))
         return(1)
-    if(args.sequential):
+    jobs = 1 if(args.sequential) else args.jobs
+    if(jobs==1):
         print("Programming sequentially")
-    timeout = 4
-    any_errors = True
-    sequential = args.sequential
-    while((timeout>0) and (any_errors)):
-        process_list = spawn_quartus_pgm(devices=devices,sof=args.sof,sequential=args.sequential)
-        error_report = report_process_status(devices, process_list, args.verbose)
-        any_errors = False
-        for d in error_report.keys():
-            if(error_report[d]):
-                print("PROGRAMMING ERROR: FPGA %s failed to program, will retry"%(d))
-                any_errors = True
-                sequential = True
-            else:
-                devices.pop(d)
+    results = program_stale_devices(devices, sof, args.state_file, args.identity_index, args.force,
+                                    jobs, args.verbose, args.retries, args.backoff)
+    any_errors = not(all(results.values()))
     if(any_errors):
         print("FATAL ERROR: failed to program one or more FPGAs")
     return 1 if any_errors else 0
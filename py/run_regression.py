@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Run the simulation tests in tests/ with results cached on their inputs
+#
+# Every tests/*/Makefile with a simulation test target is a test.  Its
+# inputs are hashed: the sources in bsv/, the test directory (BSV, Verilog,
+# Makefile and Python driver) and the py/ library.  A test whose hash
+# matches a cached pass is not rerun, and the rest are run in parallel with
+# make, each in its own directory so their named pipes do not clash.
+# Example:
+#   run_regression.py -j 4 --junit regression.xml
+# reruns only the tests affected by changes since the last run and writes a
+# JUnit XML report for CI.
+
+import sys, os, re, time, json
+import argparse, hashlib, signal
+import subprocess as sp
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+tests_dir = os.path.join(repo_root, 'tests')
+shared_inputs = [os.path.join(repo_root, 'bsv'), os.path.join(repo_root, 'py')]
+
+# make targets that run a test in simulation, in order of preference
+sim_targets = ['test', 'test_verilog']
+# files that are inputs to a test, by extension (and Makefiles)
+source_extensions = ('.bsv', '.bsvi', '.v', '.sv', '.py', '.ip', '.qsf', '.sdc', '.hex', '.mif')
+# build output directories skipped when hashing
+skip_dirs = ('output_files', '__pycache__')
+
+default_timeout = 1800
+default_cache_file = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                  'fpga-debug', 'regression.json')
+
+# Failure reported by the testers that only print a result
+failed_line = re.compile(r"Test result: FAIL")
+
+class regression_test:
+    def __init__(self, name, path, target):
+        self.name = name
+        self.path = path
+        self.target = target    # None if there is no simulation test
+
+# Returns the tests found under tests_dir, sorted by name
+def discover_tests(root=tests_dir):
+    tests = []
+    for name in sorted(os.listdir(root)):
+        makefile = os.path.join(root, name, 'Makefile')
+        if(not(os.path.isfile(makefile))):
+            continue
+        with open(makefile, 'r', errors='replace') as f:
+            targets = set(re.findall(r"^([\w\-]+)\s*:", f.read(), re.MULTILINE))
+        target = None
+        for t in sim_targets:
+            if(t in targets):
+                target = t
+                break
+        tests.append(regression_test(name, os.path.join(root, name), target))
+    return tests
+
+# Input files under path, relative to repo_root and sorted
+def source_files(path):
+    files = []
+    for (d, dirs, names) in os.walk(path):
+        dirs[:] = [x for x in dirs if(x not in skip_dirs)]
+        for n in names:
+            if(n.endswith(source_extensions) or (n == 'Makefile')):
+                files.append(os.path.relpath(os.path.join(d, n), repo_root))
+    return sorted(files)
+
+# Hashes each file only once however many tests share it
+class input_hasher:
+    def __init__(self):
+        self.digests = {}
+
+    def file_digest(self, rel):
+        if(rel not in self.digests):
+            h = hashlib.sha256()
+            with open(os.path.join(repo_root, rel), 'rb') as f:
+                for block in iter(lambda: f.read(1<<20), b''):
+                    h.update(block)
+            self.digests[rel] = h.hexdigest()
+        return self.digests[rel]
+
+    # Hash of the make target, the file names and their contents
+    def test_hash(self, test):
+        h = hashlib.sha256(test.target.encode())
+        for path in shared_inputs + [test.path]:
+            for rel in source_files(path):
+                h.update(("%s %s\n" % (rel, self.file_digest(rel))).encode())
+        return h.hexdigest()
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+# Run the test's make target.  Returns a dict of results including the
+# output.  The make is run in its own process group so that a simulator it
+# left running can be killed with it.
+def run_test(test, timeout=default_timeout):
+    result = {'name': test.name, 'passed': False, 'cached': False, 'seconds': 0.0, 'output': '', 'error': None}
+    start = time.monotonic()
+    proc = sp.Popen(["make", "-C", test.path, test.target], stdout=sp.PIPE, stderr=sp.STDOUT,
+                    start_new_session=True)
+    try:
+        (out, _) = proc.communicate(timeout=timeout)
+        result['output'] = out.decode(errors='replace')
+        if(proc.returncode != 0):
+            result['error'] = "make %s exited with status %d" % (test.target, proc.returncode)
+        elif(failed_line.search(result['output'])):
+            result['error'] = "test reported failure"
+        else:
+            result['passed'] = True
+    except sp.TimeoutExpired:
+        result['error'] = "timed out after %ds" % (timeout)
+    finally:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if(proc.returncode == None):
+            (out, _) = proc.communicate()
+            result['output'] = out.decode(errors='replace')
+    result['seconds'] = time.monotonic()-start
+    return result
+
+# Run the tests not covered by a cached pass, jobs at a time.  Returns a
+# list of results in the order of tests, with None for tests that have no
+# simulation target.
+def run_regression(tests, cache_file=default_cache_file, jobs=None, timeout=default_timeout, force=False):
+    cache = load_cache(cache_file)
+    hasher = input_hasher()
+    hashes = {}
+    results = {}
+    to_run = []
+    for test in tests:
+        if(test.target == None):
+            continue
+        hashes[test.name] = hasher.test_hash(test)
+        hit = cache.get(test.name)
+        if(not(force) and (hit != None) and (hit.get('hash') == hashes[test.name])):
+            results[test.name] = {'name': test.name, 'passed': True, 'cached': True, 'seconds': 0.0,
+                                  'output': "cached pass from %s" % (time.ctime(hit['time'])), 'error': None}
+        else:
+            to_run.append(test)
+    if(len(to_run) > 0):
+        with ThreadPoolExecutor(max_workers=jobs if(jobs!=None) else len(to_run)) as pool:
+            for r in pool.map(lambda t: run_test(t, timeout), to_run):
+                results[r['name']] = r
+    # reload in case another run has updated the cache meanwhile
+    cache = load_cache(cache_file)
+    for test in to_run:
+        if(results[test.name]['passed']):
+            cache[test.name] = {'hash': hashes[test.name], 'time': time.time(),
+                                'seconds': results[test.name]['seconds']}
+        else:
+            cache.pop(test.name, None)
+    if(len(to_run) > 0):
+        save_cache(cache_file, cache)
+    return [results.get(test.name) for test in tests]
+
+def write_junit(path, tests, results):
+    suite = ET.Element('testsuite', name='fpga-debug-regression')
+    counts = {'tests': 0, 'failures': 0, 'skipped': 0}
+    total = 0.0
+    for (test, r) in zip(tests, results):
+        case = ET.SubElement(suite, 'testcase', classname='tests', name=test.name)
+        counts['tests'] = counts['tests']+1
+        if(r == None):
+            ET.SubElement(case, 'skipped', message="no simulation test target")
+            counts['skipped'] = counts['skipped']+1
+            continue
+        case.set('time', "%.3f" % (r['seconds']))
+        total = total+r['seconds']
+        if(not(r['passed'])):
+            ET.SubElement(case, 'failure', message=r['error']).text = r['output']
+            counts['failures'] = counts['failures']+1
+        ET.SubElement(case, 'system-out').text = r['output']
+    for (k, v) in counts.items():
+        suite.set(k, str(v))
+    suite.set('time', "%.3f" % (total))
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+def report(tests, results, verbose):
+    print("%-24s %-7s %10s" % ("test", "result", "time (s)"))
+    failed = 0
+    for (test, r) in zip(tests, results):
+        if(r == None):
+            print("%-24s %-7s %10s" % (test.name, "SKIP", "-"))
+            continue
+        print("%-24s %-7s %10.1f" % (test.name, "cached" if(r['cached']) else ("PASS" if(r['passed']) else "FAIL"),
+                                     r['seconds']))
+        if(not(r['passed'])):
+            failed = failed+1
+    for (test, r) in zip(tests, results):
+        if((r != None) and (verbose or not(r['passed'])) and not(r['cached'])):
+            print("---- %s: %s" % (test.name, r['error'] if(r['error']!=None) else "passed"))
+            print(r['output'])
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(prog='run_regression.py',
+                                     description='Run the simulation tests, skipping those whose inputs match a cached pass')
+    parser.add_argument('tests', type=str, nargs='*',
+                        help='tests to run (directory names under tests/, default: all)')
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=None,
+                        help='maximum number of tests to run at once (default: all)')
+    parser.add_argument('--junit', type=str, action='store', default=None,
+                        help='write a JUnit XML report to this file')
+    parser.add_argument('--cache', type=str, action='store', default=default_cache_file,
+                        help='file holding the cached passes (default: %s)' % (default_cache_file))
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='run every test even if it has a cached pass')
+    parser.add_argument('--timeout', type=int, action='store', default=default_timeout,
+                        help='seconds allowed for each test, including building the simulation')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='show the output of passing tests too')
+    args = parser.parse_args()
+    tests = discover_tests()
+    if(len(args.tests) > 0):
+        unknown = set(args.tests) - set([t.name for t in tests])
+        if(len(unknown) > 0):
+            print("Unknown tests: %s" % (", ".join(sorted(unknown))))
+            return 1
+        tests = [t for t in tests if(t.name in args.tests)]
+    start = time.monotonic()
+    results = run_regression(tests, cache_file=args.cache, jobs=args.jobs, timeout=args.timeout, force=args.force)
+    failed = report(tests, results, args.verbose)
+    if(args.junit != None):
+        write_junit(args.junit, tests, results)
+    ran = len([r for r in results if((r != None) and not(r['cached']))])
+    print("%d failed, %d run, %d cached in %.1fs"
+          % (failed, ran, len([r for r in results if((r != None) and r['cached'])]), time.monotonic()-start))
+    return 1 if(failed > 0) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
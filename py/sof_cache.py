@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Content-addressed cache of FPGA images
+#
+# A Quartus compile of a test takes the best part of an hour, so the SOF it
+# produces is stored bzip2 compressed under a fingerprint of everything that
+# goes into it: the test's Makefile, TOP_RTL and BSV/Verilog sources, the
+# RTL_PATH library (bsv/), the INTEL_IP/DUTIP and dutip.qsf it copies into
+# de10/, the de10/ project (the Makefile, .qpf, .qsf, .sdc, .v and .ip files
+# git tracks, so IP files left behind by other tests' builds are ignored)
+# and the version of Quartus that compiles it (quartus_sh --version).  The
+# same design built on another branch or by someone else sharing the cache
+# directory (FPGA_SOF_CACHE_DIR) is then found instead of recompiled:
+#   sof_cache.py build ../tests/example_chip_id
+# fetches the image into de10/output_files/DE10_Pro.sof, or runs
+# make fpga_build and stores the result.  progallde10pro.py programs images
+# straight from the cache with --cached, e.g.
+#   progallde10pro.py --cached ../tests/example_chip_id
+# The cache is kept under a size limit by removing the least recently used
+# images.
+
+import sys, os, re, glob, time, fnmatch
+import argparse, bz2, hashlib, shutil, tempfile
+import subprocess as sp
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_cache_dir = os.environ.get('FPGA_SOF_CACHE_DIR',
+                                   os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                                'fpga-debug', 'sof-cache'))
+default_max_size = 20<<30
+
+# Files of the de10/ project that are inputs to every build, less those a
+# test's fpga_build copies in (dutip.qsf, dutip.ip and INTEL_IP).  Only files
+# tracked by git are used since fpga_build leaves its copies in de10/.
+de10_patterns = ['Makefile', '*.qpf', '*.qsf', '*.sdc', '*.v', 'Fan/*.v', '*.ip']
+de10_copied = ['dutip.qsf', 'dutip.ip']
+design_extensions = ('.bsv', '.bsvi', '.v', '.sv', '.hex', '.mif')
+
+makefile_assignment = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)\s*[:?]?=\s*(.*?)\s*$")
+makefile_reference = re.compile(r"\$\(([A-Za-z_][A-Za-z0-9_]*)\)")
+
+# Simple variable assignments in a Makefile with $(NAME) references to
+# earlier ones expanded
+def makefile_variables(path):
+    with open(path, 'r', errors='replace') as f:
+        text = f.read().replace("\\\n", " ")
+    variables = {}
+    for line in text.splitlines():
+        m = makefile_assignment.match(line.split('#')[0])
+        if(m != None):
+            variables[m.group(1)] = makefile_reference.sub(lambda r: variables.get(r.group(1), ''), m.group(2))
+    return variables
+
+# Paths of the files git tracks under directory, relative to it, or None if
+# it is not in a git checkout
+def tracked_files(directory):
+    try:
+        r = sp.run(['git', '-C', directory, 'ls-files', '-z'], stdout=sp.PIPE, stderr=sp.DEVNULL)
+    except OSError:
+        return None
+    if(r.returncode != 0):
+        return None
+    return [path for path in r.stdout.decode().split('\0') if(path != '')]
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Returns (label, path) for each input to the FPGA build of the test in
+# test_dir.  Labels name the file as the build sees it, so the same sources
+# in two test directories give the same fingerprint.
+def build_inputs(test_dir):
+    test_dir = os.path.abspath(test_dir)
+    variables = makefile_variables(os.path.join(test_dir, 'Makefile'))
+    de10 = os.path.normpath(os.path.join(test_dir, variables.get('DE10_PATH', os.path.join(repo_root, 'de10'))))
+    inputs = {'test/Makefile': os.path.join(test_dir, 'Makefile')}
+    for name in os.listdir(test_dir):
+        if(name.endswith(design_extensions)):
+            inputs['test/'+name] = os.path.join(test_dir, name)
+    if('TOP_RTL' in variables):
+        top = os.path.normpath(os.path.join(test_dir, variables['TOP_RTL']))
+        inputs['top/'+os.path.basename(top)] = top
+    if('RTL_PATH' in variables):
+        rtl = os.path.normpath(os.path.join(test_dir, variables['RTL_PATH']))
+        for name in os.listdir(rtl):
+            if(name.endswith(design_extensions)):
+                inputs['rtl/'+name] = os.path.join(rtl, name)
+    copied = list(de10_copied)
+    for ip in variables.get('INTEL_IP', '').split():
+        inputs['de10/'+os.path.basename(ip)] = os.path.join(test_dir, ip)
+        copied.append(os.path.basename(ip))
+    dutip = variables.get('DUTIP', '')
+    if((dutip != '') and (dutip != '/dev/null')):
+        inputs['de10/dutip.ip'] = os.path.join(test_dir, dutip)
+    # dutip.qsf is copied from the test if it has one
+    qsf = os.path.join(test_dir, 'dutip.qsf')
+    inputs['de10/dutip.qsf'] = qsf if(os.path.exists(qsf)) else os.path.join(de10, 'dutip.qsf')
+    tracked = tracked_files(de10)
+    for pattern in de10_patterns:
+        if(tracked == None):
+            names = [os.path.relpath(path, de10) for path in glob.glob(os.path.join(de10, pattern))]
+        else:
+            names = [name for name in tracked if(fnmatch.fnmatchcase(name, pattern) and (name.count('/') == pattern.count('/')))]
+        for name in names:
+            if((os.path.basename(name) not in copied) and os.path.isfile(os.path.join(de10, name))):
+                inputs['de10/'+name] = os.path.join(de10, name)
+    return sorted(inputs.items())
+
+quartus_version_text = None
+
+# Output of quartus_sh --version, or 'none' if Quartus is not on the path
+def quartus_version():
+    global quartus_version_text
+    if(quartus_version_text == None):
+        try:
+            r = sp.run(['quartus_sh', '--version'], stdout=sp.PIPE, stderr=sp.DEVNULL)
+            quartus_version_text = r.stdout.decode(errors='replace').strip() if(r.returncode == 0) else 'none'
+        except OSError:
+            quartus_version_text = 'none'
+    return quartus_version_text
+
+# Fingerprint of the inputs to the FPGA build of the test in test_dir and
+# the Quartus version that builds it
+def fingerprint(test_dir):
+    h = hashlib.sha256()
+    h.update(("quartus %s\n" % (quartus_version())).encode())
+    for (label, path) in build_inputs(test_dir):
+        h.update(("%s %s\n" % (label, file_digest(path))).encode())
+    return h.hexdigest()
+
+class image_store:
+    def __init__(self, path=default_cache_dir, max_size=default_max_size):
+        self.path = path
+        self.max_size = max_size
+
+    # Compressed image for key
+    def object_path(self, key):
+        return os.path.join(self.path, 'objects', key[0:2], key+'.sof.bz2')
+
+    # Decompressed copy for quartus_pgm
+    def unpacked_path(self, key):
+        return os.path.join(self.path, 'unpacked', key+'.sof')
+
+    def contains(self, key):
+        return os.path.exists(self.object_path(key))
+
+    # Compress sof into the cache under key and evict old images
+    def store(self, key, sof):
+        dest = self.object_path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(dest))
+        try:
+            with open(sof, 'rb') as src, bz2.open(os.fdopen(fd, 'wb'), 'wb') as out:
+                shutil.copyfileobj(src, out, 1<<20)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep=[dest])
+        return dest
+
+    # Path of a decompressed copy of the image for key, or None if it is
+    # not in the cache
+    def fetch(self, key):
+        src = self.object_path(key)
+        if(not(os.path.exists(src))):
+            return None
+        return self.unpack(src, key)
+
+    # Decompress a .sof.bz2 into the cache once, returning its path
+    def unpack_file(self, path):
+        return self.unpack(path, file_digest(path))
+
+    def unpack(self, src, key):
+        dest = self.unpacked_path(key)
+        if(not(os.path.exists(dest))):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(dest))
+            try:
+                with bz2.open(src, 'rb') as f, os.fdopen(fd, 'wb') as out:
+                    shutil.copyfileobj(f, out, 1<<20)
+                os.replace(tmp, dest)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            self.evict(keep=[src, dest])
+        # the modification time records the last use for eviction
+        for p in (src, dest):
+            if(p.startswith(self.path)):
+                os.utime(p)
+        return dest
+
+    # Returns a list of (last used, size, path) for every file in the cache
+    def entries(self):
+        found = []
+        for sub in ('objects', 'unpacked'):
+            for (d, dirs, names) in os.walk(os.path.join(self.path, sub)):
+                for n in names:
+                    try:
+                        st = os.stat(os.path.join(d, n))
+                        found.append((st.st_mtime, st.st_size, os.path.join(d, n)))
+                    except FileNotFoundError:
+                        pass   # removed by another process
+        return found
+
+    # Remove the least recently used files until the cache is no larger
+    # than max_size.  Returns the number of bytes freed.
+    def evict(self, keep=[]):
+        found = sorted(self.entries())
+        total = sum([size for (t, size, p) in found])
+        freed = 0
+        for (t, size, p) in found:
+            if(total <= self.max_size):
+                break
+            if(p in keep):
+                continue
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total = total-size
+            freed = freed+size
+        return freed
+
+# Fetch the image for the test in test_dir into de10/output_files, building
+# and storing it if it is not in the cache.  Returns the path of the SOF.
+def build(test_dir, cache, rebuild=False):
+    key = fingerprint(test_dir)
+    variables = makefile_variables(os.path.join(test_dir, 'Makefile'))
+    de10 = os.path.normpath(os.path.join(os.path.abspath(test_dir), variables.get('DE10_PATH', os.path.join(repo_root, 'de10'))))
+    sof = os.path.join(de10, 'output_files', 'DE10_Pro.sof')
+    cached = None if(rebuild) else cache.fetch(key)
+    if(cached != None):
+        print("Using cached image %s" % (key))
+        os.makedirs(os.path.dirname(sof), exist_ok=True)
+        shutil.copyfile(cached, sof)
+        return sof
+    print("No cached image %s, building" % (key))
+    sp.run(["make", "-C", test_dir, "fpga_build"], check=True)
+    cache.store(key, sof)
+    return sof
+
+def parse_size(text):
+    units = {'K': 1<<10, 'M': 1<<20, 'G': 1<<30, 'T': 1<<40}
+    text = text.strip().upper()
+    if(text[-1:] in units):
+        return int(float(text[:-1])*units[text[-1]])
+    return int(text)
+
+def main():
+    parser = argparse.ArgumentParser(prog='sof_cache.py', description='Content-addressed cache of FPGA images')
+    parser.add_argument('--cache-dir', type=str, action='store', default=default_cache_dir,
+                        help='cache directory (default: %s)' % (default_cache_dir))
+    parser.add_argument('--max-size', type=str, action='store', default="%dG" % (default_max_size>>30),
+                        help='size limit of the cache, e.g. 500M or 20G')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('key', help='print the fingerprint of a test\'s FPGA build')
+    p.add_argument('test_dir', type=str)
+    p.add_argument('-v', '--verbose', action='store_true', default=False, help='list the inputs too')
+    p = sub.add_parser('build', help='fetch a test\'s image into de10/output_files, building it if it is not cached')
+    p.add_argument('test_dir', type=str)
+    p.add_argument('--rebuild', action='store_true', default=False, help='build and store even if cached')
+    p = sub.add_parser('store', help='store a SOF built for a test')
+    p.add_argument('test_dir', type=str)
+    p.add_argument('sof', type=str)
+    p = sub.add_parser('fetch', help='print the path of a test\'s cached image (exit status 1 if not cached)')
+    p.add_argument('test_dir', type=str)
+    sub.add_parser('list', help='list the cached images')
+    sub.add_parser('evict', help='remove the least recently used images over the size limit')
+    args = parser.parse_args()
+    cache = image_store(args.cache_dir, parse_size(args.max_size))
+    if(args.command == 'key'):
+        if(args.verbose):
+            for (label, path) in build_inputs(args.test_dir):
+                print("%-40s %s" % (label, path))
+        print(fingerprint(args.test_dir))
+    elif(args.command == 'build'):
+        print(build(args.test_dir, cache, args.rebuild))
+    elif(args.command == 'store'):
+        print(cache.store(fingerprint(args.test_dir), args.sof))
+    elif(args.command == 'fetch'):
+        sof = cache.fetch(fingerprint(args.test_dir))
+        if(sof == None):
+            print("Not cached")
+            return 1
+        print(sof)
+    elif(args.command == 'list'):
+        for (t, size, p) in sorted(cache.entries(), reverse=True):
+            print("%s %10d %s" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(t)), size, os.path.relpath(p, cache.path)))
+    elif(args.command == 'evict'):
+        print("Freed %d bytes" % (cache.evict()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
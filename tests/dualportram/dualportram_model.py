@@ -0,0 +1,207 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# NumPy golden model of the multi-width true dual-port BRAM tester in
+# tstDualPortRAM.bsv
+#
+# Port A reads and writes 128-bit words at addrA, port B reads and writes
+# 32-bit words with byte enables at addrB, over the same memory: 32-bit word
+# addrA*4+k is bits [32k+31:32k] of 128-bit word addrA.  Within a command
+# the port A write is applied, then the port B write, then both reads.
+#
+# Commands are NumPy structured arrays of mw_command_dtype and a whole
+# sequence is applied with one call to apply(): every write is split into
+# byte writes and each byte read is resolved to the most recent earlier
+# write to that byte by sorting, so there is no Python loop per command.
+
+import numpy as np
+from collections import deque
+
+mw_command_dtype = np.dtype([("reB", "u1"), ("weB", "u1"), ("reA", "u1"), ("weA", "u1"), ("beB", "u1"),
+                             ("addrB", "<u4"), ("addrA", "<u4"),
+                             ("wr_dataB", "<u4"), ("wr_dataA_hi", "<u8"), ("wr_dataA_lo", "<u8")])
+
+# Number of commands resolved at a time by apply(), which bounds the size
+# of the temporary arrays (about 40 bytes per byte accessed)
+apply_chunk = 1<<16
+
+def mw_commands(n):
+    return np.zeros(n, dtype=mw_command_dtype)
+
+# Words written to cmdreg[4] for a sequence of commands (see write_cmd_mw in
+# tstdualportram.py)
+def encode_mw_commands(cmds):
+    return ((cmds["reB"].astype(np.uint64) & 0x1)<<35) | ((cmds["weB"].astype(np.uint64) & 0x1)<<34) \
+        | ((cmds["reA"].astype(np.uint64) & 0x1)<<33) | ((cmds["weA"].astype(np.uint64) & 0x1)<<32) \
+        | ((cmds["beB"].astype(np.uint64) & 0xf)<<28) | ((cmds["addrB"].astype(np.uint64) & 0x7fff)<<13) \
+        | (cmds["addrA"].astype(np.uint64) & 0x1fff)
+
+# Register writes (index, data) that send a sequence of commands to the
+# tester, in order: cmdreg[8] (wr_dataB) if port B writes, cmdreg[7] and
+# cmdreg[6] (wr_dataA) if port A writes, then the command to cmdreg[4].
+# Data registers a command does not use are left as they are.
+def mw_register_writes(cmds):
+    n = len(cmds)
+    index = np.empty((n, 4), dtype=np.uint8)
+    index[:] = (8, 7, 6, 4)
+    data = np.empty((n, 4), dtype=np.uint64)
+    data[:, 0] = cmds["wr_dataB"]
+    data[:, 1] = cmds["wr_dataA_hi"]
+    data[:, 2] = cmds["wr_dataA_lo"]
+    data[:, 3] = encode_mw_commands(cmds)
+    used = np.ones((n, 4), dtype=bool)
+    used[:, 0] = cmds["weB"] != 0
+    used[:, 1] = cmds["weA"] != 0
+    used[:, 2] = cmds["weA"] != 0
+    return (index[used], data[used])
+
+# FIFO of expected responses held as a deque of arrays
+class response_queue:
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.chunks = deque()
+        self.head = 0  # values already popped from chunks[0]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        if(len(values) > 0):
+            self.chunks.append(np.asarray(values, dtype=self.dtype))
+            self.size = self.size+len(values)
+
+    # Remove and return the next n values as an array
+    def pop(self, n):
+        if(n > self.size):
+            raise IndexError("pop of %d values from a response_queue holding %d" % (n, self.size))
+        out = np.empty(n, dtype=self.dtype)
+        filled = 0
+        while(filled < n):
+            chunk = self.chunks[0]
+            k = min(n-filled, len(chunk)-self.head)
+            out[filled:filled+k] = chunk[self.head:self.head+k]
+            filled = filled+k
+            self.head = self.head+k
+            if(self.head == len(chunk)):
+                self.chunks.popleft()
+                self.head = 0
+        self.size = self.size-n
+        return out
+
+    def popleft(self) -> int:
+        return int(self.pop(1)[0])
+
+    def clear(self):
+        self.chunks.clear()
+        self.head = 0
+        self.size = 0
+
+class mw_ram_model:
+    addrA_bits = 13
+    addrB_bits = 15
+
+    def __init__(self):
+        self.ram = np.zeros(1<<mw_ram_model.addrB_bits, dtype="<u4")
+        self.ram_bytes = self.ram.view(np.uint8)
+        self.respA_hi = response_queue(np.uint64)
+        self.respA_lo = response_queue(np.uint64)
+        self.respB = response_queue(np.uint32)
+
+    # 32-bit word at port B address addrB
+    def __getitem__(self, addrB):
+        return int(self.ram[addrB])
+
+    def apply_one(self, reB, weB, reA, weA, beB, addrB, addrA, wr_dataB, wr_dataA_hi, wr_dataA_lo):
+        cmd = mw_commands(1)
+        cmd[0] = (reB, weB, reA, weA, beB,
+                  addrB & ((1<<mw_ram_model.addrB_bits)-1), addrA & ((1<<mw_ram_model.addrA_bits)-1),
+                  wr_dataB & 0xffffffff, wr_dataA_hi & 0xffffffffffffffff, wr_dataA_lo & 0xffffffffffffffff)
+        self.apply(cmd)
+
+    # Apply a sequence of commands, appending the expected read responses
+    # to respA_hi/respA_lo and respB
+    def apply(self, cmds):
+        for start in range(0, len(cmds), apply_chunk):
+            self.apply_chunk(cmds[start:start+apply_chunk])
+
+    def apply_chunk(self, cmds):
+        n = len(cmds)
+        addrA = cmds["addrA"].astype(np.int64) & ((1<<mw_ram_model.addrA_bits)-1)
+        addrB = cmds["addrB"].astype(np.int64) & ((1<<mw_ram_model.addrB_bits)-1)
+        # Each access becomes byte accesses (address, order, value) where
+        # order = command*4 + 0 for port A writes, 1 for port B writes and
+        # 2 for reads
+        order = np.arange(n, dtype=np.int64)*4
+        wa = np.nonzero(cmds["weA"])[0]
+        wa_addr = (addrA[wa]*16)[:, None] + np.arange(16)
+        wa_data = np.empty((len(wa), 2), dtype="<u8")
+        wa_data[:, 0] = cmds["wr_dataA_lo"][wa]
+        wa_data[:, 1] = cmds["wr_dataA_hi"][wa]
+        wa_data = wa_data.view(np.uint8).reshape(len(wa), 16)
+        wa_order = np.repeat(order[wa], 16)
+        wb = np.nonzero(cmds["weB"])[0]
+        wb_addr = (addrB[wb]*4)[:, None] + np.arange(4)
+        wb_data = cmds["wr_dataB"][wb].astype("<u4").view(np.uint8).reshape(len(wb), 4)
+        wb_enable = ((cmds["beB"][wb][:, None] >> np.arange(4)) & 1).astype(bool)
+        wb_order = np.repeat(order[wb]+1, 4).reshape(len(wb), 4)
+        ra = np.nonzero(cmds["reA"])[0]
+        ra_addr = (addrA[ra]*16)[:, None] + np.arange(16)
+        rb = np.nonzero(cmds["reB"])[0]
+        rb_addr = (addrB[rb]*4)[:, None] + np.arange(4)
+        w_addr = np.concatenate((wa_addr.ravel(), wb_addr[wb_enable]))
+        w_order = np.concatenate((wa_order, wb_order[wb_enable]))
+        w_data = np.concatenate((wa_data.ravel(), wb_data[wb_enable]))
+        r_addr = np.concatenate((ra_addr.ravel(), rb_addr.ravel()))
+        r_order = np.concatenate((np.repeat(order[ra]+2, 16), np.repeat(order[rb]+2, 4)))
+        nw = len(w_addr)
+        addr = np.concatenate((w_addr, r_addr))
+        perm = np.lexsort((np.concatenate((w_order, r_order)), addr))
+        addr = addr[perm]
+        # For each access, the position in sorted order of the latest write
+        # to the same byte at or before it, or -1 if there is none
+        is_write = perm < nw
+        pos = np.arange(len(perm))
+        last_write = np.maximum.accumulate(np.where(is_write, pos, -1))
+        first = np.ones(len(perm), dtype=bool)
+        first[1:] = addr[1:] != addr[:-1]
+        group_start = np.maximum.accumulate(np.where(first, pos, 0))
+        hit = last_write >= group_start
+        values = self.ram_bytes[addr]
+        values[hit] = w_data[perm[last_write[hit]]]
+        read_bytes = np.empty(len(r_addr), dtype=np.uint8)
+        read_bytes[perm[~is_write]-nw] = values[~is_write]
+        # Final state: the last write to each byte
+        last = np.ones(len(perm), dtype=bool)
+        last[:-1] = addr[1:] != addr[:-1]
+        final_write = last & hit
+        self.ram_bytes[addr[final_write]] = values[final_write]
+        respA = read_bytes[0:len(ra)*16].view("<u8").reshape(len(ra), 2)
+        self.respA_lo.extend(respA[:, 0])
+        self.respA_hi.extend(respA[:, 1])
+        self.respB.extend(read_bytes[len(ra)*16:].view("<u4"))
@@ -0,0 +1,124 @@
+# Copyright (c) 2022 Simon W. Moore
+# All rights reserved.
+#
+# This software was developed at the University of Cambridge Computer
+# Laboratory (Department of Computer Science and Technology) based
+# upon work supported by the DoD Information Analysis Center Program
+# Management Office (DoD IAC PMO), sponsored by the Defense
+# Technical Information Center (DTIC) under Contract No. FA807518D0004.
+#
+# @BERI_LICENSE_HEADER_START@
+#
+# Licensed to BERI Open Systems C.I.C. (BERI) under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  BERI licenses this
+# file to you under the BERI Hardware-Software License, Version 1.0 (the
+# "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#   http://www.beri-open-systems.org/legal/license-1-0.txt
+#
+# Unless required by applicable law or agreed to in writing, Work distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+#
+# @BERI_LICENSE_HEADER_END@
+#
+# ----------------------------------------------------------------------------
+# Seeded constrained-random commands for the multi-width true dual-port BRAM
+# tester in tstDualPortRAM.bsv
+#
+# mw_stimulus generates commands as NumPy arrays of mw_command_dtype (see
+# dualportram_model.py) a batch at a time, so a soak run of any length only
+# holds one batch in memory:
+#   stim = mw_stimulus(seed=1)
+#   for cmds in stim.batches(10**7, 1024):
+#       ... send cmds to the tester and model.apply(cmds) ...
+# or one command at a time, as the arguments of write_cmd_mw(), with
+# stim.commands(n).  Each command is made from its own fixed block of raw
+# 64-bit random numbers, so the seed alone defines the stream whatever the
+# batch sizes.
+#
+# Each port reads and writes with the given probabilities and port B uses
+# all four byte enables with probability full_beB, otherwise a random mix.
+# Fields stay within the widths the tester decodes (13-bit addrA, 15-bit
+# addrB, 4-bit beB, 32-bit wr_dataB) and addresses are drawn from the first
+# `words` 128-bit words, so a small window reads back recent writes more
+# often.  The two ports of the BRAM are not ordered within a cycle, so a
+# command where both ports access the same 128-bit word and either writes
+# has no single right answer; unless collisions is True port B is moved to
+# the next word in such commands.
+#
+# The BRAM keeps its contents between runs, so a run starts with
+# fill_batches(), which writes every word of the window through port A with
+# data from the seed, to give the hardware and a fresh model the same
+# contents.
+
+import numpy as np
+from dualportram_model import mw_commands, mw_ram_model
+
+# commands generated at a time by commands()
+default_batch = 1024
+# raw 64-bit random numbers per command: port enables, byte enables and
+# addresses, wr_dataB, wr_dataA_hi, wr_dataA_lo
+raw_per_command = 5
+
+class mw_stimulus:
+    def __init__(self, seed, words=1<<mw_ram_model.addrA_bits, weA=0.5, reA=0.5, weB=0.5, reB=0.5,
+                 full_beB=0.5, collisions=False):
+        if((words < (1 if(collisions) else 2)) or (words > (1<<mw_ram_model.addrA_bits))):
+            raise ValueError("mw_stimulus window of %d words is out of range" % (words))
+        self.seed = seed
+        self.words = words
+        self.p = {"weA": weA, "reA": reA, "weB": weB, "reB": reB}
+        self.full_beB = full_beB
+        self.collisions = collisions
+        self.bits = np.random.PCG64(seed)
+        self.fill_bits = np.random.PCG64([seed, 1])
+
+    # Next n commands as an array of mw_command_dtype
+    def batch(self, n):
+        raw = self.bits.random_raw(n*raw_per_command).reshape(n, raw_per_command)
+        cmds = mw_commands(n)
+        # 16-bit fractions of the first word decide which ports read and write
+        for (k, (field, p)) in enumerate(self.p.items()):
+            cmds[field] = ((raw[:, 0] >> np.uint64(16*k)) & np.uint64(0xffff)) < int(p*0x10000)
+        full = (raw[:, 1] & np.uint64(0xffff)) < int(self.full_beB*0x10000)
+        cmds["beB"] = np.where(full, 0xf, (raw[:, 1] >> np.uint64(16)) & np.uint64(0xf))
+        cmds["addrA"] = ((raw[:, 1] >> np.uint64(20)) & np.uint64(0x3fffff)) % np.uint64(self.words)
+        cmds["addrB"] = (raw[:, 1] >> np.uint64(42)) % np.uint64(self.words*4)
+        cmds["wr_dataB"] = raw[:, 2] & np.uint64(0xffffffff)
+        cmds["wr_dataA_hi"] = raw[:, 3]
+        cmds["wr_dataA_lo"] = raw[:, 4]
+        if(not(self.collisions)):
+            portA = (cmds["weA"] | cmds["reA"]) != 0
+            portB = (cmds["weB"] | cmds["reB"]) != 0
+            writes = (cmds["weA"] | cmds["weB"]) != 0
+            clash = np.nonzero(portA & portB & writes & ((cmds["addrB"]>>2) == cmds["addrA"]))[0]
+            cmds["addrB"][clash] = (cmds["addrB"][clash]+4) % (self.words*4)
+        return cmds
+
+    # Generator of arrays of up to n port A writes that set every word of
+    # the window
+    def fill_batches(self, n=default_batch):
+        for start in range(0, self.words, n):
+            k = min(n, self.words-start)
+            cmds = mw_commands(k)
+            cmds["weA"] = 1
+            cmds["addrA"] = np.arange(start, start+k)
+            data = self.fill_bits.random_raw(2*k).reshape(k, 2)
+            cmds["wr_dataA_hi"] = data[:, 0]
+            cmds["wr_dataA_lo"] = data[:, 1]
+            yield cmds
+
+    # Generator of arrays of up to n commands, total commands in all
+    def batches(self, total, n=default_batch):
+        for start in range(0, total, n):
+            yield self.batch(min(n, total-start))
+
+    # Generator of total commands as tuples (reB, weB, reA, weA, beB, addrB,
+    # addrA, wr_dataB, wr_dataA_hi, wr_dataA_lo)
+    def commands(self, total, n=default_batch):
+        for cmds in self.batches(total, n):
+            yield from cmds.tolist()
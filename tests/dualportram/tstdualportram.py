@@ -30,10 +30,22 @@
 # ----------------------------------------------------------------------------
 # Test various memories
 
-import sys
+import sys, time
 sys.path.append(r'../../py')
 import fpga_debug_interface
+import fpga_debug_codec
 import argparse
+import numpy as np
+from dualportram_model import mw_ram_model, mw_register_writes
+from dualportram_stimulus import mw_stimulus
+
+# depth of the multi-width tester's command and read FIFOs (cmdmw, rdmwA
+# and rdmwB in tstDualPortRAM.bsv), the most commands run in one sequence
+mw_fifo_depth = 1024
+# mismatches printed in full by run_test_mw_random() before just counting
+mw_max_reported = 10
+# seconds between progress reports from run_test_mw_random()
+mw_progress_interval = 10.0
 
 class simple_test:
     def __init__(self, simulation_mode, cable_name):
@@ -43,11 +55,7 @@ class simple_test:
         self.init_ram()
 
     def init_ram(self):
-        self.ram = [None] * 1024
-        self.ram = [None] * 1024
-        self.respAhi = []
-        self.respAlo = []
-        self.respB = []
+        self.model = mw_ram_model()
         
     def read_check(self, idx, expected):
         try:
@@ -82,37 +90,23 @@ class simple_test:
         self.write_report(6,wr_dataA_lo);
         cmd = ((reB & 0x1)<<35) | ((weB & 0x1)<<34) | ((reA & 0x1)<<33) | ((weA & 0x1)<<32) | ((beB & 0xf)<<28) | ((addrB & 0x7fff)<<13) | (addrA & 0x1fff)
         self.write_report(4,cmd)
-        if(weA): # ram[] is 32b wide so split 128b writes
-            self.ram[addrA*4+0] = (wr_dataA_lo>> 0) & 0xffffffffffffffff
-            self.ram[addrA*4+1] = (wr_dataA_lo>>64) & 0xffffffffffffffff
-            self.ram[addrA*4+2] = (wr_dataA_hi>> 0) & 0xffffffffffffffff
-            self.ram[addrA*4+3] = (wr_dataA_hi>>64) & 0xffffffffffffffff
-        if(weB):
-            if(beB==0xf):
-                self.ram[addrB] = wr_dataB
-            else:
-                mask = 0
-                invmask = 0
-                for j in range(4):
-                    if((beB>>j) & 0x1 == 1):
-                        mask = mask | (0xff<<j*8)
-                    else:
-                        invmask = invmask | (0xff<<j*8)
-                self.ram[addrB] = (wr_dataB & mask) | (self.ram[addrB] & invmask)
-        if(reA):
-            self.respAlo.append((self.ram[addrA*4+1]<<32) | self.ram[addrA*4+0])
-            self.respAhi.append((self.ram[addrA*4+3]<<32) | self.ram[addrA*4+2])
-        if(reB):
-            self.respB.append(self.ram[addrB])
+        self.model.apply_one(reB, weB, reA, weA, beB, addrB, addrA, wr_dataB, wr_dataA_hi, wr_dataA_lo)
+
+    # wait for the run_sequence flag (bit 4 of cmdreg[1]) to clear
+    def wait_sp(self):
+        self.report_wait(self.dbg.wait_until(1, 1<<4, 0))
 
-    def running_sp(self):
-        return (self.dbg.read(1)>>4) & 0x1
+    # wait for the run_sequence flag (bit 6 of cmdreg[4]) to clear
+    def wait_dp(self):
+        self.report_wait(self.dbg.wait_until(4, 1<<6, 0))
 
-    def running_dp(self):
-        return (self.dbg.read(4)>>6) & 0x1
+    # wait for the run_sequence flag (bit 6 of cmdreg[8]) to clear
+    def wait_mw(self):
+        self.report_wait(self.dbg.wait_until(8, 1<<6, 0))
 
-    def running_mw(self):
-        return (self.dbg.read(8)>>6) & 0x1
+    def report_wait(self, elapsed_polls):
+        (elapsed, polls) = elapsed_polls
+        print("Test sequence finished after %.3fs (%d polls)" % (elapsed, polls))
 
     # Tests for single read, single write BRAM
     def run_test_spbram(self):
@@ -129,15 +123,15 @@ class simple_test:
 #            self.write_cmd_sp(1,1,(j+15) % 16,j,j+30000)
         print("Run sequence")
         self.write_report(1,1)
-        while(self.running_sp()):
-            print("Waiting for test sequence to finish")
+        self.wait_sp()
         print("Reading values read")
+        d = self.dbg.read_block(0, 48)
         for j in range(16):
-            print("mem[%2d] = %d" % (j,self.dbg.read(0)))
+            print("mem[%2d] = %d" % (j,d[j]))
         for j in range(16):
-            print("mem[%2d] = %d" % (j,self.dbg.read(0)))
+            print("mem[%2d] = %d" % (j,d[16+j]))
         for j in range(16):
-            print("mem[%2d] = %d" % (j^1,self.dbg.read(0)))
+            print("mem[%2d] = %d" % (j^1,d[32+j]))
 #            print("mem[%2d] = %d" % ((j+15) % 16,self.dbg.read(0)))
         self.dbg.end_simulation()
     
@@ -152,15 +146,12 @@ class simple_test:
             self.write_cmd_dp(1,0, 1,0, j*2,j*2+1, 0,0)
         print("Run sequence")
         self.write_report(3,1)
-        while(self.running_dp()):
-            print("Waiting for test sequence to finish")
+        self.wait_dp()
         print("Reading values read from port A")
-        for j in range(16):
-            d = self.dbg.read(2)
+        for (j, d) in enumerate(self.dbg.read_block(2, 16)):
             print("mem[%2d] = %d = 0x%08x" % (j*2+1,d,d))
         print("Reading values read from port B")
-        for j in range(16):
-            d = self.dbg.read(3)
+        for (j, d) in enumerate(self.dbg.read_block(3, 16)):
             print("mem[%2d] = %d = 0x%08x" % (j*2,d,d))
         self.dbg.end_simulation()
     
@@ -179,14 +170,15 @@ class simple_test:
             self.write_cmd_mw(0,0, 1,0, 0xf, 0,j, 3,2,1)
         print("Run sequence")
         self.write_report(9,1)
-        while(self.running_mw()):
-            print("Waiting for test sequence to finish")
+        self.wait_mw()
         print("Reading values read from port A")
+        # index 6 reads the upper word without dequeuing, index 5 the lower word with dequeue
+        d = self.dbg.read_many([6,5]*32)
         for j in range(32):
-            d_upper = self.dbg.read(6)
-            d_lower = self.dbg.read(5)
-            d_upper_check = self.respAhi.pop(0)
-            d_lower_check = self.respAlo.pop(0)
+            d_upper = d[j*2]
+            d_lower = d[j*2+1]
+            d_upper_check = self.model.respA_hi.popleft()
+            d_lower_check = self.model.respA_lo.popleft()
             correct = (d_upper == d_upper_check) and (d_lower == d_lower_check)
             self.error = self.error or not(correct)
             print("mem[%2d] = 0x%016x 0x%016x  check = 0x%016x 0x%016x  -  %s"
@@ -198,11 +190,9 @@ class simple_test:
             self.write_cmd_mw(1,1, 0,0, 0xf, j,0, j | 0x4000,0x1111111111111111,0x2222222222222222)
         print("Run sequence")
         self.write_report(9,1)
-        while(self.running_mw()):
-            print("Waiting for test sequence to finish")
-        for j in range(16):
-            d = self.dbg.read(7)
-            d_check = self.respB.pop(0)
+        self.wait_mw()
+        for (j, d) in enumerate(self.dbg.read_block(7, 16)):
+            d_check = self.model.respB.popleft()
             correct = d == d_check
             self.error = self.error or not(correct)
             print("mem[%2d] = 0x%08x  check = 0x%08x  -  %s"
@@ -223,11 +213,9 @@ class simple_test:
             self.write_cmd_mw(1,0, 0,0, 0xa, j,0, 0x1413121110, 0xdead0000dead0000, 0xdead0000dead0000)
         print("Run sequence")
         self.write_report(9,1)
-        while(self.running_mw()):
-            print("Waiting for test sequence to finish")
-        for j in range(16):
-            d = self.dbg.read(7)
-            d_check = self.respB.pop(0)
+        self.wait_mw()
+        for (j, d) in enumerate(self.dbg.read_block(7, 16)):
+            d_check = self.model.respB.popleft()
             correct = d == d_check
             self.error = self.error or not(correct)
             print("mem[%2d] = 0x%08x  check = 0x%08x  -  %s"
@@ -245,17 +233,91 @@ class simple_test:
                 self.write_cmd_mw(1,0, 0,1, 0xf, j*4,j, 0, 0, k)
             print("Run sequence")
             self.write_report(9,1)
-            while(self.running_mw()):
-                print("Waiting for test sequence to finish")
-            for j in range(16):
-                d = self.dbg.read(7)
-                d_check = self.respB.pop(0)
+            self.wait_mw()
+            for (j, d) in enumerate(self.dbg.read_block(7, 16)):
+                d_check = self.model.respB.popleft()
                 correct = d == d_check
                 self.error = self.error or not(correct)
                 print("mem[%2d] = 0x%08x  check = 0x%08x  -  %s"
                       % (j, d, d_check, "pass" if (correct) else "**FAIL**"))
 
         self.dbg.end_simulation()
+
+    # Send a sequence of up to mw_fifo_depth commands to the multi-width
+    # tester as one pipelined batch of register writes, apply them to the
+    # model and run the sequence.  Returns False if any write was not acked.
+    def run_mw_commands(self, cmds):
+        (index, data) = mw_register_writes(cmds)
+        writes = np.empty(len(index), dtype=[("cmd", "u1"), ("index", "u1"), ("data", "<u8")])
+        writes["cmd"] = fpga_debug_interface.DebugCommand.Cmd_write_word.value
+        writes["index"] = index
+        writes["data"] = data
+        results = self.dbg.batch(None, packets=fpga_debug_codec.encode_commands_array(writes))
+        if(any([code != fpga_debug_interface.DebugResponseCode.Rsp_write_ack for (code, d) in results])):
+            return False
+        self.model.apply(cmds)
+        self.dbg.write(9, 1)
+        self.dbg.wait_until(8, 1<<6, 0)
+        return True
+
+    # Constrained-random soak test of the multi-width BRAM: the window is
+    # filled through port A so the model matches whatever the BRAM held
+    # before, then n commands from mw_stimulus(seed) are sent a FIFO-full at
+    # a time, each sequence run and every read checked against the model
+    def run_test_mw_random(self, n, seed, chunk=mw_fifo_depth):
+        self.dbg.clear()
+        self.init_ram()
+        print("Running %d random commands with seed %d" % (n, seed))
+        stim = mw_stimulus(seed)
+        for cmds in stim.fill_batches(chunk):
+            if(not(self.run_mw_commands(cmds))):
+                print("ERROR: writes filling the BRAM were not all acknowledged")
+                self.error = True
+                self.dbg.end_simulation()
+                return
+        mismatches = 0
+        done = 0
+        start = time.monotonic()
+        report_time = start+mw_progress_interval
+        for cmds in stim.batches(n, chunk):
+            if(not(self.run_mw_commands(cmds))):
+                print("ERROR: commands %d to %d were not all acknowledged" % (done, done+len(cmds)-1))
+                self.error = True
+                break
+            nA = int(np.count_nonzero(cmds["reA"]))
+            nB = int(np.count_nonzero(cmds["reB"]))
+            # index 6 reads the upper word without dequeuing, index 5 the lower word with dequeue
+            dA = self.dbg.read_many([6,5]*nA)
+            if(None in dA):
+                print("ERROR: failed to read port A responses for commands %d to %d" % (done, done+len(cmds)-1))
+                self.error = True
+                break
+            dA = np.array(dA, dtype=np.uint64)
+            dB = np.frombuffer(self.dbg.read_block(7, nB), dtype=np.uint64)
+            got = (dA[0::2], dA[1::2], dB)
+            expected = (self.model.respA_hi.pop(nA), self.model.respA_lo.pop(nA), self.model.respB.pop(nB))
+            (posA, posB) = (np.nonzero(cmds["reA"])[0], np.nonzero(cmds["reB"])[0])
+            for (port, d, d_check, pos) in (("A hi", got[0], expected[0], posA), ("A lo", got[1], expected[1], posA),
+                                            ("B", got[2], expected[2], posB)):
+                for j in np.nonzero(d != d_check)[0]:
+                    if(mismatches < mw_max_reported):
+                        print("ERROR: command %d port %s read 0x%x but expected 0x%x  -  **FAIL**"
+                              % (done+pos[j], port, int(d[j]), int(d_check[j])))
+                    mismatches = mismatches+1
+            done = done+len(cmds)
+            now = time.monotonic()
+            if(now >= report_time):
+                print("%d of %d commands, %.0f commands/s, %d mismatches" % (done, n, done/(now-start), mismatches))
+                report_time = now+mw_progress_interval
+        if(mismatches > 0):
+            self.error = True
+        elapsed = time.monotonic()-start
+        print("%d random commands in %.1fs with %d mismatches (seed %d)" % (done, elapsed, mismatches, seed))
+        self.dbg.end_simulation()
+
+    def run_test(self):
+        # run multi-width BRAM tests but disable simultanious write port A, read port B test since it fails in simulation
+        self.run_test_mwbram(False)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -264,6 +326,10 @@ if __name__ == "__main__":
     group.add_argument('--sim', help='test in simulation (Icarus Verilog)', action="store_true")
     parser.add_argument('--n', help='number of iterations', type=int, default=1)
     parser.add_argument('--cable', help='FPGA cable name (from jtagconfig, e.g. "DE10-Pro [5-2.3.1]")', type=str, default=None)
+    parser.add_argument('--random', help='run this many constrained-random multi-width commands instead of the directed tests',
+                        type=int, default=0)
+    parser.add_argument('--seed', help='seed for --random (default: from the time), incremented for each iteration',
+                        type=int, default=None)
     args = parser.parse_args()
     if not((args.fpga and not(args.sim)) or (not(args.fpga) and args.sim)):
         parser.error('Select --fpga or --sim')
@@ -272,14 +338,16 @@ if __name__ == "__main__":
     if(args.sim):
         print("Simulation starting for %d iterations" % (args.n))
     test = simple_test(simulation_mode=args.sim, cable_name=args.cable)
+    seed = int(time.time()) if(args.seed==None) else args.seed
     for j in range(args.n):
         # test.run_test_spbram() # test single read, single write BRAM
-        # run multi-width BRAM tests but disable simultanious write port A, read port B test since it fails in simulation
-        test.run_test_mwbram(False) 
+        if(args.random > 0):
+            test.run_test_mw_random(args.random, seed+j)
+        else:
+            test.run_test()
         if(test.error):
             print("Test %d result: FAIL" % (j))
             exit(-1)
         else:
             print("Test %d result: PASS" % (j))
-    
-exit(0)
+    exit(0)
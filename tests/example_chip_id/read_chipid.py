@@ -31,7 +31,6 @@
 # Simple test of FPGADebugInterface
 
 import sys, os
-import subprocess as sp
 sys.path.append(r'../../py')
 import fpga_debug_interface
 import argparse
@@ -41,30 +40,38 @@ canned_sof = 'prebuilt_image.sof'
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    devices = progallde10pro.find_de10pro_devices()
-    k = list(devices.keys())
-    device_zero = '' if(len(k)==0) else k[0]
     parser.add_argument('-p', '--program_fpgas', action='store_true', help='program FPGAs')
     parser.add_argument('-b', '--bitimage', type=str, action='store', default=canned_sof,
                         help='specify SOF file to program (defaults to %s)'%(canned_sof))
     parser.add_argument('-s', '--sequential', action='store_true', default=False,
                         help='program FPGAs sequentially')
+    parser.add_argument('--rescan', action='store_true', default=False,
+                        help='run jtagconfig even if the cached list of boards is recent')
     group = parser.add_mutually_exclusive_group() 
     group.add_argument('-a', '--all', action='store_true', default=False, help='Read ID from all FPGAs')
-    group.add_argument('-c', '--cable', type=str, action='store', default=device_zero,
-              help='Specify cable corresponding to FPGA (obtained from jtagconfig, e.g. "DE10-Pro [5-2.3.1]")')
+    group.add_argument('-c', '--cable', type=str, action='store', default=None,
+              help='Specify cable corresponding to FPGA (obtained from jtagconfig, e.g. "DE10-Pro [5-2.3.1]", default: the first found)')
     args = parser.parse_args()
+    # only look for boards when the cable is not given
+    if(args.program_fpgas or args.all or (args.cable==None)):
+        devices = progallde10pro.find_de10pro_devices(rescan=args.rescan)
+    else:
+        devices = {}
     if(args.program_fpgas):
         print("Programming all DE10Pro FPGA boards with %s image"%(args.bitimage))
-        if(args.bitimage==canned_sof):
-            if(not(os.path.exists(canned_sof)) and os.path.exists(canned_sof+'.bz2')):
-                sp.run(['bunzip2','-k',canned_sof+'.bz2'], timeout=20, check=True)
-        process_list = progallde10pro.spawn_quartus_pgm(devices=devices,sof=args.bitimage,sequential=args.sequential)
-        progallde10pro.report_process_status(devices, process_list)
+        sof = args.bitimage
+        if((sof==canned_sof) and not(os.path.exists(canned_sof))):
+            sof = canned_sof+'.bz2'
+        # the chip ID at index 0 belongs to the board, not the design, so it
+        # cannot tell whether a board still runs this image: program them all
+        progallde10pro.program_stale_devices(devices, progallde10pro.resolve_sof(sof),
+                                             jobs = 1 if(args.sequential) else 0)
     if(args.all):
         cables = devices.keys()
-    else:
+    elif(args.cable!=None):
         cables = [args.cable]
+    else:
+        cables = list(devices.keys())[0:1]
     for c in cables:
         dbg = fpga_debug_interface.debug_interface(sim=False, cable_name=c)
         print("Cable: %s, ChipID: 0x%016x" % (c,dbg.read(0)))
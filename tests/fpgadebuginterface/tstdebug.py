@@ -36,9 +36,15 @@ import fpga_debug_interface
 import argparse
 
 class simple_test:
-    def __init__(self, simulation_mode):
+    # broker=True (or the socket path) runs the test through a link_broker.py
+    # daemon serving the simulation or cable
+    def __init__(self, simulation_mode, cable_name = None, broker = False):
         self.error = False
-        self.dbg = fpga_debug_interface.debug_interface(sim=simulation_mode)  # True=simulate, False=on FPGA
+        self.simulation_mode = simulation_mode
+        self.cable_name = cable_name
+        self.broker = broker
+        self.dbg = fpga_debug_interface.debug_interface(sim=simulation_mode,  # True=simulate, False=on FPGA
+                                                        cable_name = cable_name, broker = broker)
 
     def read_check(self, idx, expected):
         r = self.dbg.read(idx)
@@ -70,7 +76,41 @@ class simple_test:
         self.read_check(1,20)
         self.read_check(2,10)
         self.read_check(3,16)
+        if(self.dbg.bursts_supported()):
+            self.burst_check()
+        else:
+            print("Skipping the burst checks: the FPGADebugInterface build does not handle bursts")
         self.dbg.end_simulation()
+
+    # A write burst to index 4 adds every word to reg[0]; a read burst of
+    # reg[0] returns the same value each time.  Through a broker a second
+    # client's bursts are interleaved with ours to check the broker keeps
+    # the framing of each.
+    def burst_check(self):
+        words = list(range(1, 301))
+        expected = 6+sum(words)
+        failed = self.dbg.write_block(4, words)
+        values = self.dbg.read_block(0, 300)
+        if(failed or any([v != expected for v in values])):
+            print("ERROR: burst of %d words to reg[0]+: %d failed writes, read back %s but expected %d"
+                  % (len(words), len(failed), sorted(set(values)), expected))
+            self.error = True
+        else:
+            print("reg[0] +<= burst of %d words, read burst of %d == %d" % (len(words), len(values), expected))
+        if(self.broker):
+            other = fpga_debug_interface.debug_interface(sim=self.simulation_mode, cable_name=self.cable_name,
+                                                         broker=self.broker)
+            other.write_block(4, words)
+            self.dbg.write(1, 5)
+            values = other.read_block(0, 300)
+            expected = expected+sum(words)
+            if(any([v != expected for v in values])):
+                print("ERROR: second broker client read burst %s but expected %d" % (sorted(set(values)), expected))
+                self.error = True
+            else:
+                print("second broker client read burst of %d == %d" % (len(values), expected))
+            self.read_check(1, 5)
+            other.pipe.close()
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -78,6 +118,8 @@ if __name__ == "__main__":
     group.add_argument('--fpga', help='test on FPGA', action="store_true")
     group.add_argument('--sim', help='test in simulation (Icarus Verilog)', action="store_true")
     parser.add_argument('--n', help='number of iterations', type=int, default=1)
+    parser.add_argument('--broker', help='run through a link_broker.py daemon, optionally given its socket',
+                        nargs='?', const=True, default=False)
     args = parser.parse_args()
     if not((args.fpga and not(args.sim)) or (not(args.fpga) and args.sim)):
         parser.error('Select --fpga or --sim')
@@ -85,7 +127,7 @@ if __name__ == "__main__":
         print("FPGA test starting for %d iterations" % (args.n))
     if(args.sim):
         print("Simulation starting for %d iterations" % (args.n))
-    test = simple_test(args.sim)
+    test = simple_test(args.sim, broker=args.broker)
     for j in range(args.n):
         test.run_test()
         if(test.error):
@@ -93,5 +135,4 @@ if __name__ == "__main__":
             exit(-1)
         else:
             print("Test %d result: PASS" % (j))
-    
-exit(0)
+    exit(0)